@@ -3,6 +3,7 @@
 
 from trytond.pool import Pool
 from . import account
+from . import ir
 from . import journal
 from . import party
 from . import statement
@@ -11,9 +12,13 @@ from . import statement
 def register():
     Pool.register(
         account.Move,
+        ir.Cron,
         journal.StatementJournal,
         party.PartyIdentifier,
         statement.Statement,
+        statement.Origin,
+        statement.ImportCheckpoint,
+        statement.ImportJob,
         statement.ImportStatementStart,
         statement.PreloadedCardLoading,
         statement.PreloadedCardLoadingLine,
@@ -0,0 +1,113 @@
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'Helpers shared by the benchmarks'
+import csv
+import io
+import os
+import resource
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond.modules.account_statement_credicoop.instrumentation \
+    import QueryCounter  # noqa: E402
+
+HEADER = [
+    ['Banco Credicoop Coop. Ltdo.'],
+    ['Tarjetas Precargadas'],
+    ['Detalle de movimientos'],
+    [],
+    ['', '', '', 'Receptor:', 'BENCHMARK', '', '', '', 'Tarjeta:',
+        '%(card_number)s-'],
+    ['', '', '', 'Desde:', '01/01/2021', '', '', '', 'Hasta:', '31/12/2021'],
+    [],
+    ['', 'Fecha', 'Nro. Op.', 'Concepto', 'Descripción', '', 'Detalle', '',
+        'Débito', '', '', '', 'Crédito'],
+    ]
+
+
+def format_amount(cents):
+    units, cents = divmod(cents, 100)
+    return '{:,}'.format(units).replace(',', '.') + ',%02d' % cents
+
+
+def generate_export(rows, card_number='4000-0000-0000-0001', start=0,
+        encoding='windows-1252'):
+    'Return a synthetic Credicoop Precargadas export of rows moves'
+    f = io.StringIO()
+    writer = csv.writer(f, lineterminator='\r\n')
+    for row in HEADER:
+        writer.writerow([c % {'card_number': card_number} for c in row])
+    first_day = date(2021, 1, 1)
+    for i in range(start, start + rows):
+        amount = format_amount(100 + (i * 7919) % 1000000)
+        if i % 10:
+            debit, credit = amount, '0,00'
+        else:
+            debit, credit = '0,00', amount
+        writer.writerow([
+                '', (first_day + timedelta(days=i % 365)).strftime(
+                    '%d/%m/%Y'),
+                str(1000000 + i), 'COMPRA', 'Comercio %s' % (i % 97), '',
+                'Compra en comercio', '', debit, '', '', '', credit])
+    return f.getvalue().encode(encoding)
+
+
+class Stage(object):
+    '''Measure the duration, queries and peak memory of a stage
+
+    The peak memory is the maximum resident size of the process unless
+    trace_memory is set, then it is the peak of the memory allocated by
+    Python during the stage (tracemalloc slows down the stage a lot).
+    '''
+    trace_memory = False
+
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self._queries = QueryCounter().__enter__()
+        if self.trace_memory:
+            tracemalloc.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.duration = time.perf_counter() - self._start
+        if self.trace_memory:
+            _, self.peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            self.peak = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * 1024
+        self._queries.__exit__(type, value, traceback)
+        self.queries = self._queries.count
+        if type is None:
+            print(self, flush=True)
+
+    @staticmethod
+    def header():
+        return '%-16s %10s %10s %12s %10s %10s' % (
+            'stage', 'rows', 'seconds', 'rows/s', 'queries', 'peak MiB')
+
+    def __str__(self):
+        return '%-16s %10d %10.3f %12.0f %10d %10.1f' % (
+            self.name, self.rows, self.duration,
+            self.rows / self.duration if self.duration else 0,
+            self.queries, self.peak / 2 ** 20)
+
+
+def setup_company(company, number='4000-0000-0000-0001'):
+    '''Create a chart, a fiscal year for 2021 and a statement journal
+    for the number to the company'''
+    from trytond.modules.account.tests import create_chart
+    from trytond.modules.account_statement_credicoop.tests.\
+        test_account_statement import (
+            create_fiscalyear, create_statement_journal)
+
+    create_chart(company)
+    create_fiscalyear(company)
+    return create_statement_journal(company, number)
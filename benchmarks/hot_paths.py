@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''Benchmark the statement import and move creation hot paths
+
+For each size, a synthetic Credicoop Precargadas export and a batch of
+preloaded card loadings are generated and the following stages are
+measured:
+
+    parse          Precargadas eager parsing
+    parse-stream   Precargadas streaming parsing
+    parse-zip-N    parse_files of the size moves split in N files
+    import         ImportStatement.parse_credicoop_precargadas and save
+    create-move    Statement.create_move on a grouped journal
+    add-lines      PreloadedCardLoading.add_lines with size active parties
+    post           PreloadedCardLoading.post
+    export         PreloadedCardLoadingReport.execute of the posted loadings
+
+It runs on the database of the trytond test environment, for example
+on PostgreSQL with:
+
+    TRYTOND_DATABASE_URI=postgresql:/// DB_NAME=bench \\
+        python benchmarks/hot_paths.py --sizes 1000 10000
+'''
+import argparse
+import io
+from datetime import date
+from decimal import Decimal
+from unittest.mock import patch
+
+from common import Stage, generate_export, setup_company
+
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, DB_NAME
+from trytond.transaction import Transaction
+
+
+def bench_parse(size):
+    from trytond.modules.account_statement_credicoop.credicoop_precargadas \
+        import Precargadas
+
+    data = generate_export(size)
+    with Stage('parse', size):
+        statement, = Precargadas(io.BytesIO(data)).statements
+    assert len(statement.moves) == size
+    with Stage('parse-stream', size):
+        statement, = Precargadas(io.BytesIO(data), streaming=True).statements
+        count = sum(1 for _ in statement.moves)
+    assert count == size
+
+
+def bench_parse_zip(size, counts=(24, 4)):
+    from trytond.modules.account_statement_credicoop.credicoop_precargadas \
+        import parse_files
+
+    for count in counts:
+        files = [generate_export(size // count,
+                card_number='4000-0000-0000-%04d' % i,
+                start=i * (size // count))
+            for i in range(count)]
+        with Stage('parse-zip-%s' % count, size):
+            statements = parse_files(files)
+        assert len(statements) == count
+
+
+def bench_import(company, size, start):
+    pool = Pool()
+    Statement = pool.get('account.statement')
+    ImportStatement = pool.get('account.statement.import', type='wizard')
+
+    data = generate_export(size, start=start)
+    session_id, _, _ = ImportStatement.create()
+    import_statement = ImportStatement(session_id)
+    import_statement.start.company = company
+    import_statement.start.file_format = 'credicoop_precargadas'
+    import_statement.start.file_ = data
+    with Stage('import', size):
+        statements = list(import_statement.parse_credicoop_precargadas())
+        Statement.save(statements)
+    ImportStatement.delete(session_id)
+
+
+def bench_create_move(company, journal, size):
+    pool = Pool()
+    Account = pool.get('account.account')
+    Statement = pool.get('account.statement')
+
+    accounts = Account.search([
+            ('company', '=', company.id),
+            ['OR',
+                ('type.revenue', '=', True),
+                ('type.expense', '=', True),
+                ],
+            ])
+    journal.group_moves_by_account = True
+    journal.save()
+    lines = [{
+            'date': date(2021, i % 12 + 1, i % 28 + 1),
+            'amount': Decimal(-(i % 1000) - 1),
+            'account': accounts[i % len(accounts)].id,
+            'description': 'Line %s' % i,
+            } for i in range(size)]
+    end_balance = sum(l['amount'] for l in lines)
+    statement, = Statement.create([{
+                'name': 'Benchmark %s' % size,
+                'company': company.id,
+                'journal': journal.id,
+                'date': date(2021, 12, 31),
+                'start_balance': Decimal(0),
+                'end_balance': end_balance,
+                'lines': [('create', lines)],
+                }])
+    with Stage('create-move', size):
+        Statement.create_move([statement])
+
+
+def bench_add_lines(company, size):
+    pool = Pool()
+    Account = pool.get('account.account')
+    Journal = pool.get('account.journal')
+    Party = pool.get('party.party')
+    CardLoading = pool.get('account.preloaded_card.loading')
+
+    cash, = Account.search([
+            ('company', '=', company.id),
+            ('name', '=', 'Main Cash'),
+            ])
+    journal, = Journal.search([('type', '=', 'cash')], limit=1)
+    parties = Party.create([{
+                'name': 'Partner %s' % i,
+                'identifiers': [('create', [{
+                                'type': 'ar_tarjeta_precargada',
+                                'code': str(4000000000000000 + i),
+                                }])] if i % 10 else [],
+                } for i in range(size)])
+    # The active partners of cooperative_ar are replaced by the parties
+    # in reverse order to check that the order is kept
+    active = [p.id for p in reversed(parties)]
+    card_loading = CardLoading(
+        credit_account=cash, debit_account=cash, journal=journal, lines=[])
+    with patch.object(CardLoading, '_get_active_parties',
+            return_value=active):
+        with Stage('add-lines', size):
+            card_loading.add_lines()
+    assert [l.party.id for l in card_loading.lines] == active
+
+
+def bench_post(company, size, loadings=10):
+    pool = Pool()
+    Account = pool.get('account.account')
+    Journal = pool.get('account.journal')
+    Party = pool.get('party.party')
+    CardLoading = pool.get('account.preloaded_card.loading')
+    Report = pool.get('account.preloaded_card.loading.report', type='report')
+
+    cash, = Account.search([
+            ('company', '=', company.id),
+            ('name', '=', 'Main Cash'),
+            ])
+    receivable, = Account.search([
+            ('company', '=', company.id),
+            ('type.receivable', '=', True),
+            ])
+    journal, = Journal.search([('type', '=', 'cash')], limit=1)
+    parties = Party.create([{'name': 'Party %s' % i} for i in range(100)])
+    per_loading = max(size // loadings, 1)
+    card_loadings = CardLoading.create([{
+                'date': date(2021, i % 12 + 1, 10),
+                'description': 'Benchmark %s' % i,
+                'journal': journal.id,
+                'credit_account': cash.id,
+                'debit_account': receivable.id,
+                'lines': [('create', [{
+                                'party': parties[j % len(parties)].id,
+                                'card_number': str(j),
+                                'amount': Decimal(j % 1000 + 1),
+                                } for j in range(per_loading)])],
+                } for i in range(loadings)])
+    with Stage('post', per_loading * loadings):
+        CardLoading.post(card_loadings)
+    ids = [c.id for c in card_loadings]
+    with Stage('export', per_loading * loadings):
+        Report.execute(ids, {
+                'model': CardLoading.__name__,
+                'id': ids[0],
+                'ids': ids,
+                })
+
+
+def main(sizes):
+    from trytond.modules.company.tests import create_company, set_company
+
+    for size in sizes:
+        bench_parse(size)
+        bench_parse_zip(size)
+
+    activate_module('account_statement_credicoop')
+    with Transaction().start(DB_NAME, 0):
+        company = create_company()
+        with set_company(company):
+            journal = setup_company(company)
+            start = 0
+            for size in sizes:
+                bench_import(company, size, start)
+                start += size
+            for size in sizes:
+                bench_create_move(company, journal, size)
+            for size in sizes:
+                bench_add_lines(company, size)
+            for size in sizes:
+                bench_post(company, size)
+        Transaction().rollback()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[1000, 10000, 100000])
+    parser.add_argument('--trace-memory', action='store_true',
+        help='report the Python memory peak of each stage (slow)')
+    args = parser.parse_args()
+    Stage.trace_memory = args.trace_memory
+    print(Stage.header())
+    main(args.sizes)
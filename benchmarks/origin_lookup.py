@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''Benchmark the lookup of already imported Credicoop moves
+
+The origins table is filled with synthetic origins up to each size and
+the time to check a batch of moves against it is measured.
+
+    DB_NAME=:memory: python benchmarks/origin_lookup.py
+'''
+import argparse
+import random
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from common import setup_company
+
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, DB_NAME
+from trytond.transaction import Transaction
+
+Move = namedtuple('Move', ['date', 'op_number'])
+
+START_DATE = date(2015, 1, 1)
+
+
+def origin_key(i):
+    return START_DATE + timedelta(days=i % 3650), str(1000000 + i)
+
+
+def fill_origins(statement, start, stop):
+    pool = Pool()
+    Origin = pool.get('account.statement.origin')
+    origin = Origin.__table__()
+    cursor = Transaction().connection.cursor()
+
+    now = datetime.now()
+    for i in range(start, stop, 10000):
+        values = []
+        for j in range(i, min(i + 10000, stop)):
+            date_, number = origin_key(j)
+            values.append([statement.id, number, date_, -1, 0, now])
+        cursor.execute(*origin.insert(
+                [origin.statement, origin.number, origin.date,
+                    origin.amount, origin.create_uid, origin.create_date],
+                values))
+
+
+def lookup(import_statement, size, batch):
+    moves = []
+    for _ in range(batch // 2):
+        moves.append(Move(*origin_key(random.randrange(size))))
+        moves.append(Move(*origin_key(size + random.randrange(size))))
+    start = time.perf_counter()
+    processed = import_statement.processed_moves(moves)
+    duration = time.perf_counter() - start
+    assert len(processed) == len({m for m in moves if m in processed})
+    return duration
+
+
+def main(sizes, batch, repeat, index):
+    from trytond.modules.company.tests import create_company, set_company
+
+    activate_module('account_statement_credicoop')
+    with Transaction().start(DB_NAME, 0):
+        pool = Pool()
+        Statement = pool.get('account.statement')
+        Origin = pool.get('account.statement.origin')
+        ImportStatement = pool.get(
+            'account.statement.import', type='wizard')
+
+        if not index:
+            table_h = Origin.__table_handler__()
+            table_h.index_action(['number', 'date'], 'remove')
+
+        company = create_company()
+        with set_company(company):
+            journal = setup_company(company, '4000')
+            statement = Statement(
+                name='Benchmark', company=company, journal=journal,
+                date=START_DATE, start_balance=0, end_balance=0)
+            statement.save()
+
+            session_id, _, _ = ImportStatement.create()
+            import_statement = ImportStatement(session_id)
+
+            print('%12s %12s %12s %12s' % (
+                    'origins', 'moves', 'seconds', 'us/move'))
+            filled = 0
+            for size in sorted(sizes):
+                fill_origins(statement, filled, size)
+                filled = size
+                duration = min(
+                    lookup(import_statement, size, batch)
+                    for _ in range(repeat))
+                print('%12d %12d %12.4f %12.1f' % (
+                        size, batch, duration, duration / batch * 10 ** 6))
+        Transaction().rollback()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[10000, 100000, 1000000])
+    parser.add_argument('--batch', type=int, default=1000,
+        help='number of moves checked per lookup')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--no-index', dest='index', action='store_false',
+        help='drop the (number, date) index before measuring')
+    args = parser.parse_args()
+    main(args.sizes, args.batch, args.repeat, args.index)
@@ -0,0 +1,46 @@
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'Formatting of the fields of the Credicoop fixed-width files'
+from decimal import Decimal, ROUND_HALF_EVEN
+from functools import lru_cache
+from unicodedata import category, normalize
+
+_CENT = Decimal('0.01')
+
+
+class _Transliteration(dict):
+    'Translation table of characters to their unaccented form'
+
+    def __missing__(self, code):
+        value = ''.join(c for c in normalize('NFD', chr(code))
+            if category(c) != 'Mn')
+        self[code] = value
+        return value
+
+
+_TRANSLITERATION = _Transliteration()
+
+
+def strip_accents(string):
+    'Return the string without its combining marks'
+    if string.isascii():
+        return string
+    return normalize('NFC', string).translate(_TRANSLITERATION)
+
+
+def justify(string, size):
+    return string.ljust(size)
+
+
+@lru_cache(maxsize=1024)
+def format_description(description, size=60):
+    'Return the description unaccented and padded to the size'
+    return justify(strip_accents(description or ''), size)
+
+
+def format_amount(amount, size=9):
+    'Return the absolute amount in cents padded with zeros to the size'
+    if not isinstance(amount, Decimal):
+        amount = Decimal(amount)
+    cents = abs(amount).quantize(_CENT, rounding=ROUND_HALF_EVEN)
+    return str(cents).replace('.', '').rjust(size, '0')
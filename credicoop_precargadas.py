@@ -2,15 +2,47 @@
 # the full copyright notices and license terms.
 import io
 import csv
-from datetime import datetime
+import hashlib
+import logging
+import os
+import pickle
+import subprocess
+import sys
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from itertools import chain, islice
 from decimal import Decimal
 
+logger = logging.getLogger(__name__)
+
 
 def _date(value):
     v = value.strip()
     return datetime.strptime(v, '%d/%m/%Y').date()
 
 
+def _is_date(value):
+    v = value.strip()
+    if (len(v) == 10 and v[2] == '/' and v[5] == '/'
+            and (v[:2] + v[3:5] + v[6:]).isdigit()):
+        return True
+    try:
+        _date(v)
+    except ValueError:
+        return False
+    return True
+
+
+def _fingerprint(rows, fingerprint):
+    'Chain the hash of the rows to the fingerprint of the previous rows'
+    for row in rows:
+        fingerprint = hashlib.sha1(
+            (fingerprint + '\x1f'.join(row)).encode('utf-8')).hexdigest()
+    return fingerprint
+
+
 def _string(value):
     return value.strip()
 
@@ -24,6 +56,84 @@ def _amount(value):
     return Decimal(value.replace(',', '.'))
 
 
+def _dates(values):
+    # Most of the moves share a few dates
+    dates = {}
+    result = []
+    for value in values:
+        if value not in dates:
+            v = value.strip()
+            if (len(v) == 10 and v[2] == '/' and v[5] == '/'
+                    and (v[:2] + v[3:5] + v[6:]).isdigit()):
+                try:
+                    dates[value] = date(int(v[6:]), int(v[3:5]), int(v[:2]))
+                except ValueError:
+                    pass
+            if value not in dates:
+                # Let strptime accept or reject the other formats
+                dates[value] = _date(value)
+        result.append(dates[value])
+    return result
+
+
+def _strings(values):
+    return [v.strip() for v in values]
+
+
+_AMOUNT_TABLE = str.maketrans({'.': None, ',': '.'})
+
+
+def _amounts(values):
+    amounts = {}
+    result = []
+    for value in values:
+        if value not in amounts:
+            amounts[value] = Decimal(value.translate(_AMOUNT_TABLE))
+        result.append(amounts[value])
+    return result
+
+
+# Parsers of a whole column of values
+COLUMN_PARSERS = {
+    _date: _dates,
+    _string: _strings,
+    _amount: _amounts,
+    }
+
+
+def _store_dates(values):
+    return array('i', map(date.toordinal, values)), date.fromordinal
+
+
+def _store_strings(values):
+    # Most of the descriptions are repeated
+    return list(map(sys.intern, values)), None
+
+
+def _cents(value):
+    return Decimal(value).scaleb(-2)
+
+
+def _store_amounts(values):
+    for value in values:
+        sign, digits, exponent = value.as_tuple()
+        # Keep the amounts that the cents would not give back identical
+        if exponent != -2 or (sign and not any(digits)):
+            return list(values), None
+    try:
+        return array('q', (int(v.scaleb(2)) for v in values)), _cents
+    except OverflowError:
+        return list(values), None
+
+
+# Compact storage of a column of parsed values and its decoder
+COLUMN_STORES = {
+    _date: _store_dates,
+    _string: _store_strings,
+    _amount: _store_amounts,
+    }
+
+
 RECEIVER = {
     'receiver': (4, _string),
     'card_number': (9, _card_string),
@@ -46,47 +156,150 @@ MOVE = {
 
 
 class Precargadas(object):
+    '''Credicoop preloaded cards statement parser
+
+    A file may contain the export of many cards, each one starting with
+    its receiver and period rows. They are all read in a single pass.
 
-    def __init__(self, name, encoding='windows-1252'):
-        self.statements = []
+    With streaming, the statements are an iterator and the moves of each
+    statement are an iterator that reads the file as it is consumed.
+    The moves not consumed when the next statement is read are kept in
+    memory.
+    '''
 
+    def __init__(self, name, encoding='windows-1252', streaming=False):
         if isinstance(name, (bytes, str)):
-            with io.open(name, encoding=encoding, mode='r') as f:
-                self._parse(f)
+            f = io.open(name, encoding=encoding, mode='r')
+        elif isinstance(name, (io.RawIOBase, io.BufferedIOBase)):
+            f = io.TextIOWrapper(name, encoding=encoding, newline='')
         else:
-            self._parse(name)
+            f = name
 
-    def _parse(self, f):
+        if streaming:
+            self.statements = self._iter_statements(
+                f, f if f is not name else None)
+        else:
+            self.statements = []
+            if f is not name:
+                with f:
+                    self._parse(f)
+            else:
+                self._parse(f)
+
+    def _read(self, f):
+        '''Yield ('statement', (receiver row, period row)) for the header
+        of each statement and ('move', row) for each of its move rows
+        '''
+        previous = None
+        columns = False
+        started = False
+        for row in csv.reader(f, delimiter=','):
+            if len(row) < 2:
+                pass
+            elif row[1] == '':
+                if (len(row) > 9
+                        and _is_date(row[4]) and _is_date(row[9])):
+                    yield 'statement', (previous, row)
+                    started = columns = True
+            elif started:
+                # The first row of the statement may be the column titles
+                if not columns or _is_date(row[1]):
+                    yield 'move', row
+                columns = False
+            previous = row
+
+    def _new_statement(self, receiver, period):
         statement = Statement()
-        self.statements.append(statement)
-
-        csv_reader = csv.reader(f, delimiter=',')
-        line = 0
-        debit_total = 0
-        credit_total = 0
-        for row in csv_reader:
-            line += 1
-            if line in range(1, 5):
-                continue
-            elif line == 5:
-                self._parse_statement(row, statement, RECEIVER)
-            elif line == 6:
-                self._parse_statement(row, statement, PERIOD)
-            elif line in range(7, 9):
+        self._parse_statement(receiver, statement, RECEIVER)
+        self._parse_statement(period, statement, PERIOD)
+        statement.debit_total = 0
+        statement.credit_total = 0
+        return statement
+
+    def _parse(self, f):
+        statement = None
+        rows = []
+        for kind, value in self._read(f):
+            if kind == 'move':
+                rows.append(value)
                 continue
+            if statement is not None:
+                statement.moves = self._parse_moves(rows, statement)
+            statement = self._new_statement(*value)
+            self.statements.append(statement)
+            rows = []
+        if statement is not None:
+            statement.moves = self._parse_moves(rows, statement)
+
+    def _iter_statements(self, f, close=None):
+        try:
+            rows = self._read(f)
+            header = next((v for k, v in rows if k == 'statement'), None)
+            while header is not None:
+                statement = self._new_statement(*header)
+                statement_rows = _StatementRows(rows)
+                statement.moves = self._iter_moves(statement_rows, statement)
+                yield statement
+                statement_rows.read()
+                header = statement_rows.next_header
+        finally:
+            if close is not None:
+                close.close()
+
+    def _iter_moves(self, rows, statement, count=1000):
+        if statement.skip:
+            # The skipped rows are only hashed
+            count_, fingerprint = statement.skip
+            skipped = list(islice(rows, count_))
+            if (len(skipped) == count_
+                    and _fingerprint(skipped, '') == fingerprint):
+                statement.skipped = count_
+                statement.fingerprint = fingerprint
             else:
-                if row[1] == '':
-                    continue
-                move = Move()
-                self._parse_move(row, move, MOVE)
-                if row[8]:
-                    debit_total += _amount(row[8])
-                if row[12]:
-                    credit_total += _amount(row[12])
-                statement.moves.append(move)
-        statement.debit_total = debit_total
-        statement.credit_total = credit_total
-        return
+                rows = chain(skipped, rows)
+        while True:
+            sub_rows = list(islice(rows, count))
+            if not sub_rows:
+                break
+            yield from self._parse_moves(sub_rows, statement)
+
+    def _parse_moves(self, rows, statement):
+        '''Return the moves of the rows decoded column by column
+        and add their amounts to the totals of the statement
+        '''
+        names = list(MOVE.keys())
+        columns = []
+        for name in names:
+            col, parser = MOVE[name]
+            values = [r[col] for r in rows]
+            if parser in COLUMN_PARSERS:
+                columns.append(COLUMN_PARSERS[parser](values))
+            else:
+                columns.append(list(map(parser, values)))
+
+        for name in ['debit', 'credit']:
+            total = sum(columns[names.index(name)])
+            setattr(statement, name + '_total',
+                getattr(statement, name + '_total') + total)
+
+        fingerprints = []
+        fingerprint = statement.fingerprint
+        sha1, join = hashlib.sha1, '\x1f'.join
+        for row in rows:
+            # Same as _fingerprint
+            digest = sha1((fingerprint + join(row)).encode('utf-8')).digest()
+            fingerprint = digest.hex()
+            fingerprints.append(digest)
+        statement.fingerprint = fingerprint
+
+        stored = {}
+        for name, values in zip(names, columns):
+            _, parser = MOVE[name]
+            if parser in COLUMN_STORES:
+                stored[name] = COLUMN_STORES[parser](values)
+            else:
+                stored[name] = (values, None)
+        return MoveStore(stored, b''.join(fingerprints))
 
     def _parse_statement(self, row, statement, desc):
         for name, (col, parser) in desc.items():
@@ -99,17 +312,210 @@ class Precargadas(object):
             setattr(move, name, value)
 
 
+class _StatementRows(object):
+    'Iterator over the move rows of a statement up to the next statement'
+
+    def __init__(self, rows):
+        self._rows = rows
+        self._buffer = deque()
+        self._done = False
+        self.next_header = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._buffer:
+            return self._buffer.popleft()
+        return self._next_row()
+
+    def _next_row(self):
+        if not self._done:
+            for kind, value in self._rows:
+                if kind == 'move':
+                    return value
+                self.next_header = value
+                break
+            self._done = True
+        raise StopIteration
+
+    def read(self):
+        'Keep the remaining rows to reach the next statement'
+        self._buffer.extend(iter(self._next_row, None))
+
+
 class Statement(object):
     __slots__ = list(RECEIVER.keys()) + list(PERIOD.keys()) + [
-        'debit_total', 'credit_total', 'moves']
+        'debit_total', 'credit_total', 'moves', 'fingerprint', 'skip',
+        'skipped']
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.moves = []
+        self.fingerprint = ''
+        self.skip = None
+        self.skipped = 0
+
+    def skip_moves(self, count, fingerprint):
+        '''Skip the first moves if their fingerprint matches,
+        it must be called before reading them
+        '''
+        if not count:
+            return
+        if isinstance(self.moves, (list, MoveStore)):
+            if (len(self.moves) >= count
+                    and self.moves[count - 1].fingerprint == fingerprint):
+                self.moves = self.moves[count:]
+                self.skipped = count
+        else:
+            self.skip = (count, fingerprint)
 
 
 class Move(object):
-    __slots__ = list(MOVE.keys())
+    __slots__ = list(MOVE.keys()) + ['fingerprint']
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+
+
+class MoveStore(object):
+    '''Columns of parsed moves
+
+    The dates are stored as day ordinals, the amounts as cents and the
+    strings are interned. The moves are views that decode their values
+    when they are read.
+    '''
+    __slots__ = ('_columns', '_fingerprints')
+    _digest_size = hashlib.sha1().digest_size
+
+    def __init__(self, columns, fingerprints):
+        # The columns map the name to the values and their decoder
+        self._columns = columns
+        self._fingerprints = fingerprints
+
+    def __len__(self):
+        return len(self._fingerprints) // self._digest_size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('MoveStore slice step must be 1')
+            size = self._digest_size
+            return MoveStore({
+                    n: (v[start:stop], d)
+                    for n, (v, d) in self._columns.items()},
+                self._fingerprints[start * size:stop * size])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('MoveStore index out of range')
+        return MoveView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield MoveView(self, index)
+
+    def get(self, index, name):
+        'Return the value of the field of the move at the index'
+        if name == 'fingerprint':
+            size = self._digest_size
+            return self._fingerprints[index * size:(index + 1) * size].hex()
+        values, decode = self._columns[name]
+        value = values[index]
+        if decode is not None:
+            value = decode(value)
+        return value
+
+
+class MoveView(object):
+    'Move read from a MoveStore'
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    def __getattr__(self, name):
+        try:
+            return self._store.get(self._index, name)
+        except KeyError:
+            raise AttributeError(name)
+
+
+def _parse_data(data, encoding):
+    return Precargadas(io.BytesIO(data), encoding=encoding).statements
+
+
+# The archives smaller than this are parsed in process because starting
+# the child interpreters costs more than parsing them
+PROCESS_MIN_SIZE = 4 * 2 ** 20
+
+# The child loads only the parser file under its name, so it neither runs
+# the __main__ script of the server nor imports the whole package and it
+# pickles the classes under the name known by the server
+_CHILD = (
+    'import importlib.util, sys\n'
+    'spec = importlib.util.spec_from_file_location(%r, %r)\n'
+    'module = sys.modules[spec.name] = importlib.util.module_from_spec(spec)\n'
+    'spec.loader.exec_module(module)\n'
+    'module._child()\n' % (__name__, os.path.abspath(__file__)))
+
+
+def _child():
+    files, encoding = pickle.load(sys.stdin.buffer)
+    pickle.dump([_parse_data(data, encoding) for data in files],
+        sys.stdout.buffer, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _parse_batch_process(files, encoding):
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [p for p in sys.path if p]
+        + [p for p in [env.get('PYTHONPATH')] if p])
+    try:
+        process = subprocess.run([sys.executable, '-c', _CHILD],
+            input=pickle.dumps((files, encoding)), env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return pickle.loads(process.stdout)
+    except (OSError, subprocess.CalledProcessError, pickle.PickleError,
+            EOFError) as exception:
+        logger.warning('parse process failed, parsing in process: %s',
+            getattr(exception, 'stderr', None) or exception)
+        return [_parse_data(data, encoding) for data in files]
+
+
+def _batches(files, count):
+    'Return the indexes of the files split in count batches of similar size'
+    batches = [[] for _ in range(count)]
+    sizes = [0] * count
+    for index in sorted(
+            range(len(files)), key=lambda i: len(files[i]), reverse=True):
+        i = sizes.index(min(sizes))
+        batches[i].append(index)
+        sizes[i] += len(files[index])
+    return [b for b in batches if b]
+
+
+def parse_files(files, encoding='windows-1252', max_workers=None,
+        min_size=PROCESS_MIN_SIZE):
+    '''Parse the content of the files in child processes
+    and return the list of their statements in the same order
+    '''
+    workers = min(max_workers or os.cpu_count() or 1, len(files))
+    if workers < 2 or sum(len(d) for d in files) < min_size:
+        return [s for data in files for s in _parse_data(data, encoding)]
+    # Each child is a new interpreter started with the parser only,
+    # neither forked from the server nor spawned by multiprocessing
+    # which would run the script of the server again, and it parses
+    # a batch of files to start only one interpreter per worker
+    batches = _batches(files, workers)
+    results = [None] * len(files)
+    with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        for batch, statements in zip(batches, executor.map(
+                    lambda b: _parse_batch_process(
+                        [files[i] for i in b], encoding),
+                    batches)):
+            for index, file_statements in zip(batch, statements):
+                results[index] = file_statements
+    return [s for statements in results for s in statements]
@@ -0,0 +1,162 @@
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+
+def profile_enabled():
+    return (Transaction().context.get('credicoop_profile')
+        or config.getboolean(
+            'account_statement_credicoop', 'profile', default=False))
+
+
+class _Counting(object):
+    '''The counters of a connection, they all count its queries until
+    the last one exits
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.counters = []
+        if hasattr(connection, 'set_trace_callback'):
+            # SQLite calls back for each statement of the connection
+            connection.set_trace_callback(self.count)
+        else:
+            # The cursors of the connection count their queries
+            self._cursor_factory = factory = connection.cursor_factory
+            count = self.count
+
+            class CountingCursor(factory):
+                def execute(self, *args, **kwargs):
+                    count()
+                    return super().execute(*args, **kwargs)
+
+                def executemany(self, *args, **kwargs):
+                    count()
+                    return super().executemany(*args, **kwargs)
+            connection.cursor_factory = CountingCursor
+
+    def count(self, *args):
+        for counter in self.counters:
+            counter.count += 1
+
+    def close(self):
+        if hasattr(self.connection, 'set_trace_callback'):
+            self.connection.set_trace_callback(None)
+        else:
+            self.connection.cursor_factory = self._cursor_factory
+
+
+class QueryCounter(object):
+    '''Count the SQL queries executed by the transaction
+
+    Only the connection of the transaction is instrumented and the
+    counters may be nested.
+    '''
+    # The counting connections of the thread by id
+    _local = threading.local()
+
+    def __init__(self):
+        self.count = 0
+
+    @classmethod
+    def _get_countings(cls):
+        try:
+            return cls._local.countings
+        except AttributeError:
+            cls._local.countings = countings = {}
+            return countings
+
+    def __enter__(self):
+        self._connection = Transaction().connection
+        if self._connection is not None:
+            countings = self._get_countings()
+            key = id(self._connection)
+            if key not in countings:
+                countings[key] = _Counting(self._connection)
+            countings[key].counters.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._connection is not None:
+            countings = self._get_countings()
+            key = id(self._connection)
+            counting = countings[key]
+            counting.counters.remove(self)
+            if not counting.counters:
+                counting.close()
+                del countings[key]
+
+
+class Profiler(object):
+    '''Record the wall time, the SQL queries and the rows of the stages
+    of an operation
+
+    It records nothing unless the credicoop_profile context key or the
+    profile option of the account_statement_credicoop configuration
+    section is set.
+    '''
+
+    def __init__(self, name, enabled=None):
+        self.name = name
+        self.enabled = profile_enabled() if enabled is None else enabled
+        self.stages = {}
+        self._counter = None
+
+    def __enter__(self):
+        if self.enabled:
+            self._counter = QueryCounter().__enter__()
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.enabled:
+            self.duration = time.perf_counter() - self._start
+            self.queries = self._counter.count
+            self._counter.__exit__(type, value, traceback)
+            if type is None:
+                logger.info('%s: %s', self.name, self.summary())
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        'Add the time and queries of the block to the stage'
+        if not self.enabled:
+            yield
+            return
+        queries = self._counter.count
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self._get_stage(name)
+            stage['duration'] += time.perf_counter() - start
+            stage['queries'] += self._counter.count - queries
+            stage['rows'] += rows
+
+    def add_rows(self, name, rows):
+        if self.enabled:
+            self._get_stage(name)['rows'] += rows
+
+    def _get_stage(self, name):
+        return self.stages.setdefault(name, {
+                'duration': 0,
+                'queries': 0,
+                'rows': 0,
+                })
+
+    def summary(self):
+        'Return the stages as a dictionary'
+        summary = {
+            'stages': {n: dict(s) for n, s in self.stages.items()},
+            }
+        if hasattr(self, 'duration'):
+            summary['duration'] = self.duration
+            summary['queries'] = self.queries
+        return summary
@@ -1,13 +1,73 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import defaultdict
+from weakref import WeakKeyDictionary
 
 from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
 
 
 class PartyIdentifier(metaclass=PoolMeta):
     __name__ = 'party.identifier'
+    # Transaction scoped mappings of the Precargada identifiers
+    _precargadas = WeakKeyDictionary()
 
     @classmethod
     def get_types(cls):
         types = super().get_types()
         return types + [('ar_tarjeta_precargada', 'Precargada')]
+
+    @classmethod
+    def create(cls, vlist):
+        cls._precargadas.pop(Transaction(), None)
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._precargadas.pop(Transaction(), None)
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, identifiers):
+        cls._precargadas.pop(Transaction(), None)
+        super().delete(identifiers)
+
+    @classmethod
+    def _get_precargadas(cls):
+        '''Return the mappings of card number to party ids
+        and party id to card numbers of the Precargada identifiers
+        '''
+        transaction = Transaction()
+        try:
+            return cls._precargadas[transaction]
+        except KeyError:
+            pass
+        table = cls.__table__()
+        cursor = transaction.connection.cursor()
+
+        parties = defaultdict(list)
+        card_numbers = defaultdict(list)
+        cursor.execute(*table.select(table.code, table.party,
+                where=table.type == 'ar_tarjeta_precargada'))
+        for code, party in cursor:
+            parties[code].append(party)
+            card_numbers[party].append(code)
+        cls._precargadas[transaction] = precargadas = (
+            dict(parties), dict(card_numbers))
+        return precargadas
+
+    @classmethod
+    def get_precargada_party(cls, card_number):
+        'Return the party id identified by the card number'
+        parties, _ = cls._get_precargadas()
+        parties = parties.get(card_number, [])
+        if len(parties) == 1:
+            return parties[0]
+
+    @classmethod
+    def get_precargada_card_number(cls, party):
+        'Return the card number of the party'
+        _, card_numbers = cls._get_precargadas()
+        card_numbers = card_numbers.get(int(party), [])
+        if len(card_numbers) == 1:
+            return card_numbers[0]
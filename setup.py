@@ -82,7 +82,7 @@ setup(name='%s_%s' % (PREFIX, MODULE),
     package_data={
         'trytond.modules.%s' % MODULE: (info.get('xml', []) + [
             'tryton.cfg', 'view/*.xml', 'locale/*.po', '*.txt',
-            'tests/*.rst']),
+            'tests/*.rst', 'tests/*.csv']),
         },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -1,31 +1,76 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from io import StringIO
+import hashlib
+import logging
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO, StringIO
 from decimal import Decimal
-from itertools import groupby
-from datetime import date
-from unicodedata import normalize as unicode_normalize
-from unicodedata import category as unicode_category
+from itertools import groupby, islice
+from datetime import date, datetime, timedelta
 
-from trytond.model import Workflow, ModelView, ModelSQL, fields
+from sql.aggregate import Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+
+from trytond.config import config
+from trytond.model import Model, Workflow, ModelView, ModelSQL, fields
+from trytond.model.exceptions import AccessButtonError
 from trytond.report import Report
+from trytond.rpc import RPC
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.transaction import Transaction
+from trytond.wizard import StateAction
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.modules.account_statement.exceptions import ImportStatementError
-from .credicoop_precargadas import Precargadas
+from .credicoop_format import (
+    format_amount, format_description, justify, strip_accents)
+from .credicoop_precargadas import Precargadas, parse_files
+from .instrumentation import Profiler
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodCache(object):
+    'Cache the periods found by company and date'
+
+    def __init__(self):
+        self._periods = {}
+
+    def find(self, company, date):
+        'Return the period id and its end date for the company at the date'
+        key = (int(company), date)
+        if key not in self._periods:
+            Period = Pool().get('account.period')
+            period_id = Period.find(int(company), date=date)
+            self._periods[key] = (period_id, Period(period_id).end_date)
+        return self._periods[key]
 
 
 class Statement(metaclass=PoolMeta):
     __name__ = 'account.statement'
+    profile = fields.Dict(None, "Profile", readonly=True,
+        help="The time, queries and rows of the last import and move "
+        "creation stages.")
 
     @property
     def lines_party(self):
-        parties = [l.party for l in self.lines if l.party]
+        pool = Pool()
+        Line = pool.get('account.statement.line')
+        Party = pool.get('party.party')
+        # Read the parties at once as the context of the party field
+        # depends on the line
+        parties = {v['party'] for v in Line.read(
+                    [l.id for l in self.lines], ['party'])
+            if v['party'] is not None}
         if parties:
-            return list(set(parties))[0]
+            return Party(list(parties)[0])
         return None
 
     @classmethod
@@ -38,76 +83,156 @@ class Statement(metaclass=PoolMeta):
         Move = pool.get('account.move')
         MoveLine = pool.get('account.move.line')
 
-        moves = []
-        for statement in statements:
-            if statement.journal.group_moves_by_account:
-                # Added code for custom grouping
-                for key, lines in groupby(
-                        statement.lines,
-                        key=statement._group_by_account_period):
-                    lines = list(lines)
-                    key = dict(key)
-                    key['description'] = statement.journal.name
-                    move = statement._get_move_by_account_period(key)
-                    moves.append((move, statement, lines))
-            else:
-                # Standard behavior
-                for key, lines in groupby(
-                        statement.lines, key=statement._group_key):
-                    lines = list(lines)
-                    key = dict(key)
-                    move = statement._get_move(key)
-                    moves.append((move, statement, lines))
-
-        Move.save([m for m, _, _ in moves])
-
-        to_write = []
-        for move, _, lines in moves:
-            to_write.append(lines)
-            to_write.append({
-                    'move': move.id,
-                    })
-        if to_write:
-            Line.write(*to_write)
-
-        move_lines = []
-        for move, statement, lines in moves:
-            amount = 0
-            amount_second_currency = 0
-            for line in lines:
-                move_line = line.get_move_line()
-                move_line.move = move
-                amount += move_line.debit - move_line.credit
-                if move_line.amount_second_currency:
-                    amount_second_currency += move_line.amount_second_currency
-                move_lines.append((move_line, line))
-
-            move_line = statement._get_move_line(
-                amount, amount_second_currency, lines)
-            move_line.move = move
-            move_lines.append((move_line, None))
-
-        MoveLine.save([l for l, _ in move_lines])
-
-        Line.reconcile(move_lines)
+        with Profiler('account.statement.create_move') as profiler:
+            periods = PeriodCache()
+            moves = []
+            # The values of the lines of grouped journals by id
+            lines_values = {}
+            with profiler.stage('group'):
+                for statement in statements:
+                    if statement.journal.group_moves_by_account:
+                        # Added code for custom grouping
+                        values = statement._get_lines_values()
+                        lines_values.update(values)
+                        for key, lines in (
+                                statement._group_lines_by_account_period(
+                                    statement.lines, values=values)):
+                            key = dict(key)
+                            key['description'] = statement.journal.name
+                            move = statement._get_move_by_account_period(
+                                key, periods=periods)
+                            moves.append((move, statement, lines))
+                    else:
+                        # Standard behavior
+                        for key, lines in groupby(
+                                statement.lines, key=statement._group_key):
+                            lines = list(lines)
+                            key = dict(key)
+                            move = statement._get_move(key)
+                            moves.append((move, statement, lines))
+
+            with profiler.stage('save_moves', rows=len(moves)):
+                Move.save([m for m, _, _ in moves])
+
+            to_write = []
+            for move, _, lines in moves:
+                to_write.append(lines)
+                to_write.append({
+                        'move': move.id,
+                        })
+            with profiler.stage('write_lines'):
+                if to_write:
+                    Line.write(*to_write)
+
+            move_lines = []
+            with profiler.stage('move_lines'):
+                for move, statement, lines in moves:
+                    if statement.journal.group_moves_by_account:
+                        lines = statement._get_lines_from_values(
+                            lines, lines_values)
+                    amount = 0
+                    amount_second_currency = 0
+                    for line in lines:
+                        move_line = line.get_move_line()
+                        move_line.move = move
+                        amount += move_line.debit - move_line.credit
+                        if move_line.amount_second_currency:
+                            amount_second_currency += (
+                                move_line.amount_second_currency)
+                        move_lines.append((move_line, line))
+
+                    move_line = statement._get_move_line(
+                        amount, amount_second_currency, lines)
+                    move_line.move = move
+                    move_lines.append((move_line, None))
+            profiler.add_rows('move_lines', len(move_lines))
+
+            with profiler.stage('save_move_lines', rows=len(move_lines)):
+                MoveLine.save([l for l, _ in move_lines])
+
+            with profiler.stage('reconcile'):
+                Line.reconcile(move_lines)
+
+        if profiler.enabled:
+            cls.write(*sum((([s], {
+                                'profile': dict(s.profile or {},
+                                    create_move=profiler.summary()),
+                                }) for s in statements), ()))
         return moves
 
-    def _group_by_account_period(self, line):
+    def _get_lines_values(self):
+        'Return the values of the lines by id'
+        pool = Pool()
+        Line = pool.get('account.statement.line')
+        # Reading the account of each line instance would query the line
+        # as its context depends on the date of the line
+        return {v['id']: v for v in Line.read(
+                [l.id for l in self.lines],
+                ['date', 'amount', 'account', 'party', 'description',
+                    'invoice'])}
+
+    def _get_lines_from_values(self, lines, values):
+        '''Return instances of the lines built from their values
+        so get_move_line does not read each line
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        Line = pool.get('account.statement.line')
+        accounts = {}
+        result = []
+        for line in lines:
+            line_values = values[line.id]
+            account = line_values['account']
+            if account not in accounts:
+                accounts[account] = Account(account)
+            result.append(Line(line.id,
+                    statement=self,
+                    date=line_values['date'],
+                    amount=line_values['amount'],
+                    description=line_values['description'],
+                    account=accounts[account],
+                    party=line_values['party'],
+                    invoice=line_values['invoice']))
+        return result
+
+    def _group_by_account_period(self, line, values=None):
         # Group by account and period
+        if values is not None:
+            Account = Pool().get('account.account')
+            line_values = values[line.id]
+            account = Account(line_values['account'])
+            date = line_values['date']
+        else:
+            account, date = line.account, line.date
         key = (
-            ('account', line.account),
-            ('date', (line.date.year, line.date.month)),
+            ('account', account),
+            ('date', (date.year, date.month)),
             )
         return key
 
-    def _get_move_by_account_period(self, key):
+    def _group_lines_by_account_period(self, lines, values=None):
+        '''Return the list of key and lines grouped by account and period
+        sorted by key whatever the order of the lines
+        '''
+        groups = {}
+        for line in lines:
+            key = self._group_by_account_period(line, values=values)
+            groups.setdefault(key, []).append(line)
+
+        def sort_key(item):
+            key, _ = item
+            return tuple(int(v) if isinstance(v, Model) else v
+                for _, v in key)
+        return sorted(groups.items(), key=sort_key)
+
+    def _get_move_by_account_period(self, key, periods=None):
         pool = Pool()
         Move = pool.get('account.move')
-        Period = pool.get('account.period')
 
+        if periods is None:
+            periods = PeriodCache()
         date_period = date(key['date'][0], key['date'][1], 1)
-        period_id = Period.find(self.company.id, date=date_period)
-        date_period = Period(period_id).end_date
+        period_id, date_period = periods.find(self.company, date_period)
         return Move(
             period=period_id,
             journal=self.journal.journal,
@@ -125,56 +250,563 @@ class Statement(metaclass=PoolMeta):
         return move
 
 
+class Origin(metaclass=PoolMeta):
+    __name__ = 'account.statement.origin'
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+
+        table_h = cls.__table_handler__(module_name)
+
+        # Index used to find already imported moves
+        table_h.index_action(['number', 'date'], 'add')
+
+
+class ImportCheckpoint(ModelSQL, ModelView):
+    'Statement Import Checkpoint'
+    __name__ = 'account.statement.import.checkpoint'
+
+    company = fields.Many2One('company.company', 'Company',
+        required=True, readonly=True, select=True)
+    file_hash = fields.Char('File Hash', required=True, readonly=True,
+        select=True)
+    card_number = fields.Char('Card Number', readonly=True)
+    date_from = fields.Date('Date From', readonly=True)
+    statement = fields.Many2One('account.statement', 'Statement',
+        readonly=True, ondelete='CASCADE')
+    rows = fields.Integer('Rows', readonly=True,
+        help='The number of rows of the statement already processed.')
+    last_number = fields.Char('Last Number', readonly=True,
+        help='The operation number of the last row processed.')
+    fingerprint = fields.Char('Fingerprint', readonly=True,
+        help='The chained hash of the rows already processed.')
+    file_statements = fields.Integer('File Statements', readonly=True,
+        help='The number of statements of the file once it is imported.')
+    state = fields.Selection([
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ], 'State', readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order = [
+            ('create_date', 'DESC'),
+            ('id', 'DESC'),
+            ]
+
+    @staticmethod
+    def default_rows():
+        return 0
+
+    @staticmethod
+    def default_state():
+        return 'running'
+
+    @staticmethod
+    def hash(data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    @classmethod
+    def imported(cls, company, file_hash):
+        'Test if the file has already been fully imported'
+        checkpoints = cls.search([
+                ('company', '=', company.id),
+                ('file_hash', '=', file_hash),
+                ('statement', '!=', None),
+                ])
+        if not checkpoints or any(c.state != 'done' for c in checkpoints):
+            return False
+        # The checkpoints are deleted with their statement
+        statements = {(c.card_number, c.date_from) for c in checkpoints}
+        file_statements = max(c.file_statements or 0 for c in checkpoints)
+        return bool(file_statements) and len(statements) >= file_statements
+
+    @classmethod
+    def get_checkpoint(cls, company, file_hash, ccoop_statement):
+        '''Return the checkpoint of the import of the statement
+        and the last checkpoint of the statement
+        '''
+        checkpoints = cls.search([
+                ('company', '=', company.id),
+                ('card_number', '=', ccoop_statement.card_number),
+                ('date_from', '=', ccoop_statement.date_from),
+                ('statement', '!=', None),
+                ], limit=1)
+        previous = checkpoints[0] if checkpoints else None
+        if (previous and previous.state == 'running'
+                and previous.file_hash == file_hash):
+            return previous, previous
+        checkpoint = cls(
+            company=company,
+            file_hash=file_hash,
+            card_number=ccoop_statement.card_number,
+            date_from=ccoop_statement.date_from,
+            statement=None,
+            rows=0,
+            fingerprint='',
+            last_number=None,
+            file_statements=None,
+            state='running')
+        return checkpoint, previous
+
+
+class ImportJob(Workflow, ModelSQL, ModelView):
+    'Statement Import Job'
+    __name__ = 'account.statement.import.job'
+
+    company = fields.Many2One('company.company', 'Company',
+        required=True, readonly=True, select=True)
+    file_ = fields.Binary('File', required=True, readonly=True)
+    file_format = fields.Char('File Format', required=True, readonly=True)
+    file_hash = fields.Char('File Hash', readonly=True)
+    parsed = fields.Integer('Parsed', readonly=True,
+        help='The number of rows read from the file.')
+    skipped = fields.Integer('Skipped', readonly=True,
+        help='The number of rows already imported.')
+    imported = fields.Integer('Imported', readonly=True,
+        help='The number of rows imported as origins.')
+    statements = fields.Function(fields.One2Many(
+            'account.statement', None, 'Statements'), 'get_statements')
+    message = fields.Text('Message', readonly=True)
+    state = fields.Selection([
+        ('waiting', 'Waiting'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], 'State', readonly=True, select=True)
+
+    # Fallback of the imports when there is no queue worker
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order = [
+            ('create_date', 'DESC'),
+            ('id', 'DESC'),
+            ]
+        cls._transitions |= set((
+                ('waiting', 'running'),
+                ('running', 'waiting'),
+                ('running', 'done'),
+                ('running', 'failed'),
+                ))
+
+    @staticmethod
+    def default_parsed():
+        return 0
+
+    @staticmethod
+    def default_skipped():
+        return 0
+
+    @staticmethod
+    def default_imported():
+        return 0
+
+    @staticmethod
+    def default_state():
+        return 'waiting'
+
+    def get_statements(self, name):
+        pool = Pool()
+        Checkpoint = pool.get('account.statement.import.checkpoint')
+        checkpoints = Checkpoint.search([
+                ('company', '=', self.company.id),
+                ('file_hash', '=', self.file_hash),
+                ('statement', '!=', None),
+                ], order=[('id', 'ASC')])
+        return list(dict.fromkeys(c.statement.id for c in checkpoints))
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Checkpoint = pool.get('account.statement.import.checkpoint')
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            if values.get('file_') and not values.get('file_hash'):
+                values['file_hash'] = Checkpoint.hash(values['file_'])
+        return super().create(vlist)
+
+    @classmethod
+    def enqueue(cls, jobs):
+        '''Process the jobs in the queue worker or, without worker,
+        in a thread once the transaction is finished
+        '''
+        if config.getboolean('queue', 'worker', default=False):
+            cls.__queue__.process(jobs)
+        else:
+            transaction = Transaction()
+            context = dict(transaction.context)
+            context.pop('_check_access', None)
+            transaction.atexit(cls._submit, transaction.database.name,
+                transaction.user, context, list(map(int, jobs)))
+
+    @classmethod
+    def _submit(cls, database_name, user, context, ids):
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=config.getint(
+                        'account_statement_credicoop', 'import_workers',
+                        default=1),
+                    thread_name_prefix='statement-import')
+        cls._executor.submit(cls._run, database_name, user, context, ids)
+
+    @classmethod
+    def _run(cls, database_name, user, context, ids):
+        try:
+            with Transaction().start(database_name, user, context=context):
+                Job = Pool().get(cls.__name__)
+                Job.process(Job.search([
+                            ('id', 'in', ids),
+                            ('state', '=', 'waiting'),
+                            ]))
+        except Exception:
+            logger.error('statement import jobs %s failed', ids,
+                exc_info=True)
+
+    @classmethod
+    def process_waiting(cls):
+        '''Process the jobs waiting for longer than the delay
+        as those of the thread fallback are lost on restart
+        and resume the jobs interrupted while running
+        '''
+        transaction = Transaction()
+        delay = config.getint(
+            'account_statement_credicoop', 'import_job_delay',
+            default=15 * 60)
+        limit = datetime.now() - timedelta(seconds=delay)
+        # The running jobs record their progress after each statement
+        # so those without progress since the delay were interrupted
+        for job in cls.search([
+                    ('state', '=', 'running'),
+                    ('write_date', '<', limit),
+                    ]):
+            try:
+                cls.lock([job])
+            except backend.DatabaseOperationalError:
+                transaction.rollback()
+                continue
+            job = cls(job.id)
+            if job.state == 'running' and job.write_date < limit:
+                logger.warning('statement import job %s interrupted, '
+                    'resuming', job.id)
+                cls.wait([job])
+            transaction.commit()
+        cls.process(cls.search([
+                    ('state', '=', 'waiting'),
+                    ('create_date', '<', limit),
+                    ], order=[('create_date', 'ASC'), ('id', 'ASC')]))
+
+    @classmethod
+    @Workflow.transition('waiting')
+    def wait(cls, jobs):
+        pass
+
+    @classmethod
+    @Workflow.transition('running')
+    def run(cls, jobs):
+        pass
+
+    @classmethod
+    @Workflow.transition('done')
+    def done(cls, jobs):
+        pass
+
+    @classmethod
+    @Workflow.transition('failed')
+    def fail(cls, jobs):
+        pass
+
+    @classmethod
+    def process(cls, jobs):
+        '''Import the files of the jobs
+        committing the progress after each statement
+        '''
+        pool = Pool()
+        ImportStatement = pool.get('account.statement.import', type='wizard')
+        transaction = Transaction()
+
+        for job in jobs:
+            # The job may be processed by the cron and the thread fallback
+            try:
+                cls.lock([job])
+            except backend.DatabaseOperationalError:
+                transaction.rollback()
+                continue
+            job = cls(job.id)
+            if job.state != 'waiting':
+                continue
+            cls.run([job])
+            transaction.commit()
+            session_id, _, _ = ImportStatement.create()
+            try:
+                import_statement = ImportStatement(session_id)
+                import_statement.start.company = job.company
+                import_statement.start.file_format = job.file_format
+                import_statement.start.file_ = job.file_
+                with transaction.set_context(statement_import_job=job.id):
+                    for statement in getattr(import_statement,
+                            'parse_%s' % job.file_format)():
+                        statement.origin_file = fields.Binary.cast(job.file_)
+                        statement.save()
+                        transaction.commit()
+            except Exception as exception:
+                logger.error('statement import job %s failed', job.id,
+                    exc_info=True)
+                transaction.rollback()
+                job = cls(job.id)
+                job.message = str(exception)
+                job.save()
+                cls.fail([job])
+            else:
+                cls.done([job])
+            finally:
+                ImportStatement.delete(session_id)
+            transaction.commit()
+
+    @classmethod
+    def add_progress(cls, job_id, parsed=0, skipped=0, imported=0):
+        'Add the row counts to the job and mark it as alive'
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.update(
+                [table.parsed, table.skipped, table.imported,
+                    table.write_date],
+                [table.parsed + parsed, table.skipped + skipped,
+                    table.imported + imported, CurrentTimestamp()],
+                where=table.id == job_id))
+
+
 class ImportStatementStart(metaclass=PoolMeta):
     __name__ = 'account.statement.import.start'
 
+    credicoop_background = fields.Boolean('Background',
+        states={
+            'invisible': Eval('file_format') != 'credicoop_precargadas',
+            },
+        depends=['file_format'],
+        help='Import the file in the background and follow its progress.')
+
     @classmethod
     def __setup__(cls):
         super().__setup__()
         precargadas = ('credicoop_precargadas', 'Credicoop Precargadas')
         cls.file_format.selection.append(precargadas)
 
+    @classmethod
+    def default_credicoop_background(cls):
+        return config.getboolean(
+            'account_statement_credicoop', 'import_background', default=False)
+
 
 class ImportStatement(metaclass=PoolMeta):
     __name__ = 'account.statement.import'
+    import_background = StateAction(
+        'account_statement_credicoop.act_statement_import_job')
+
+    def do_import_(self, action):
+        if (self.start.file_format == 'credicoop_precargadas'
+                and self.start.credicoop_background):
+            return self.do_import_background(
+                self.import_background.get_action())
+        return super().do_import_(action)
+
+    def do_import_background(self, action):
+        pool = Pool()
+        Job = pool.get('account.statement.import.job')
+
+        job = Job(
+            company=self.start.company,
+            file_format=self.start.file_format,
+            file_=self.start.file_)
+        job.save()
+        Job.enqueue([job])
+        action['views'].reverse()
+        return action, {'res_id': [job.id]}
 
     def parse_credicoop_precargadas(self, encoding='windows-1252'):
+        pool = Pool()
+        Checkpoint = pool.get('account.statement.import.checkpoint')
+
         file_ = self.start.file_
-        if not isinstance(file_, str):
-            file_ = file_.decode(encoding)
-        file_ = StringIO(file_)
-        precargadas = Precargadas(file_)
-        for ccoop_statement in precargadas.statements:
-            statement = self.precargadas_statement(ccoop_statement)
-            debit_total = 0
-            lines_count = 0
-            origins = []
-            for move in ccoop_statement.moves:
-                # Only debits
-                if move.debit == Decimal('0.00'):
-                    continue
-                if self.already_processed_move(move):
-                    continue
-                origins.extend(self.precargadas_origin(ccoop_statement, move))
-                debit_total -= move.debit
-                lines_count += 1
-
-            statement.start_balance = 0
-            statement.end_balance = debit_total
-            statement.total_amount = debit_total
-            statement.number_of_lines = lines_count
-            statement.origins = origins
+        company = self.start.company
+        file_hash = Checkpoint.hash(file_)
+        if Checkpoint.imported(company, file_hash):
+            logger.info('file %s already imported', file_hash)
+            return
+        if isinstance(file_, str):
+            ccoop_statements = Precargadas(
+                StringIO(file_), streaming=True).statements
+        elif zipfile.is_zipfile(BytesIO(file_)):
+            with zipfile.ZipFile(BytesIO(file_)) as archive:
+                files = [archive.read(i) for i in archive.infolist()
+                    if not i.is_dir()]
+            ccoop_statements = parse_files(files, encoding=encoding,
+                max_workers=config.getint(
+                    'account_statement_credicoop', 'parse_workers',
+                    default=None))
+        else:
+            ccoop_statements = Precargadas(
+                BytesIO(file_), encoding=encoding, streaming=True).statements
+
+        # Commit the origins by chunks to resume interrupted imports
+        chunk = config.getint(
+            'account_statement_credicoop', 'import_chunk', default=0)
+        file_statements = 0
+        for ccoop_statement in ccoop_statements:
+            file_statements += 1
+            with Profiler('account.statement.import') as profiler:
+                with profiler.stage('statement'):
+                    checkpoint, previous = Checkpoint.get_checkpoint(
+                        company, file_hash, ccoop_statement)
+                    # The rows already processed are skipped if unchanged
+                    if previous:
+                        ccoop_statement.skip_moves(
+                            previous.rows, previous.fingerprint)
+                    if checkpoint.statement:
+                        statement = checkpoint.statement
+                    else:
+                        statement = self.precargadas_statement(
+                            ccoop_statement)
+                        statement.start_balance = 0
+                        statement.end_balance = 0
+                        statement.total_amount = 0
+                        statement.number_of_lines = 0
+                with profiler.stage('party'):
+                    # The values shared by all the origins of the statement
+                    statement_values = (
+                        self.precargadas_statement_origin_values(
+                            ccoop_statement))
+                origins = []
+                rows = 0
+                grouped_moves = self._grouped_moves(
+                    ccoop_statement.moves, count=chunk or None)
+                while True:
+                    with profiler.stage('parse'):
+                        sub_moves = next(grouped_moves, None)
+                    if sub_moves is None:
+                        break
+                    profiler.add_rows('parse', len(sub_moves))
+                    # Only debits
+                    debit_moves = [m for m in sub_moves
+                        if m.debit != Decimal('0.00')]
+                    with profiler.stage(
+                            'deduplicate', rows=len(debit_moves)):
+                        processed = self.processed_moves(debit_moves)
+                    with profiler.stage('origins'):
+                        imported = 0
+                        for move in debit_moves:
+                            if (move.date, move.op_number) in processed:
+                                continue
+                            origins.extend(self.precargadas_origin_values(
+                                    ccoop_statement, move, statement_values))
+                            statement.end_balance -= move.debit
+                            statement.total_amount -= move.debit
+                            statement.number_of_lines += 1
+                            imported += 1
+                        profiler.add_rows('origins', imported)
+                    self.precargadas_progress(parsed=len(sub_moves),
+                        skipped=len(debit_moves) - imported,
+                        imported=imported)
+                    rows += len(sub_moves)
+                    checkpoint.rows = ccoop_statement.skipped + rows
+                    checkpoint.fingerprint = sub_moves[-1].fingerprint
+                    checkpoint.last_number = sub_moves[-1].op_number
+                    if chunk:
+                        with profiler.stage('commit', rows=len(origins)):
+                            self.precargadas_commit(
+                                statement, origins, checkpoint)
+                        origins = []
+
+                self.precargadas_progress(parsed=ccoop_statement.skipped,
+                    skipped=ccoop_statement.skipped)
+                if not rows and ccoop_statement.skipped:
+                    checkpoint.rows = previous.rows
+                    checkpoint.fingerprint = previous.fingerprint
+                    checkpoint.last_number = previous.last_number
+                statement.save()
+                with profiler.stage('create', rows=len(origins)):
+                    self.precargadas_create_origins(statement, origins)
+                checkpoint.statement = statement
+                checkpoint.state = 'done'
+                checkpoint.save()
+            if profiler.enabled:
+                statement.profile = {'import': profiler.summary()}
             yield statement
+        Checkpoint.write(Checkpoint.search([
+                    ('company', '=', company.id),
+                    ('file_hash', '=', file_hash),
+                    ]), {
+                'file_statements': file_statements,
+                })
+
+    def precargadas_progress(self, parsed=0, skipped=0, imported=0):
+        'Report the rows processed to the import job of the context'
+        pool = Pool()
+        Job = pool.get('account.statement.import.job')
+        job_id = Transaction().context.get('statement_import_job')
+        if job_id is not None:
+            Job.add_progress(job_id, parsed=parsed, skipped=skipped,
+                imported=imported)
+
+    def precargadas_commit(self, statement, origins, checkpoint):
+        'Save and commit the statement, the origin values and the checkpoint'
+        statement.save()
+        self.precargadas_create_origins(statement, origins)
+        checkpoint.statement = statement
+        checkpoint.save()
+        Transaction().commit()
+
+    def precargadas_create_origins(self, statement, origins):
+        'Create the origins of the saved statement from their values'
+        pool = Pool()
+        Origin = pool.get('account.statement.origin')
+
+        for sub_origins in grouped_slice(origins):
+            Origin.create([dict(v, statement=statement.id)
+                    for v in sub_origins])
+
+    @staticmethod
+    def _grouped_moves(moves, count=None):
+        if count is None:
+            count = Transaction().database.IN_MAX
+        moves = iter(moves)
+        while True:
+            sub_moves = list(islice(moves, count))
+            if not sub_moves:
+                break
+            yield sub_moves
 
     def already_processed_move(self, move):
+        return bool(self.processed_moves([move]))
+
+    def processed_moves(self, moves):
+        '''Return the set of (date, op_number) of the moves
+        that already have an origin
+        '''
         pool = Pool()
         Origin = pool.get('account.statement.origin')
-
-        origins = Origin.search([
-            ('date', '=', move.date),
-            ('number', '=', move.op_number),
-            ])
-        return origins and True or False
+        origin = Origin.__table__()
+        cursor = Transaction().connection.cursor()
+
+        keys = {(m.date, m.op_number) for m in moves}
+        processed = set()
+        for sub_keys in grouped_slice(list(keys)):
+            sub_keys = list(sub_keys)
+            dates = list({d for d, _ in sub_keys})
+            numbers = list({n for _, n in sub_keys})
+            cursor.execute(*origin.select(origin.date, origin.number,
+                    where=origin.number.in_(numbers)
+                    & origin.date.in_(dates)))
+            processed.update(k for k in cursor if k in keys)
+        return processed
 
     def precargadas_statement(self, ccoop_statement):
         pool = Pool()
@@ -205,27 +837,39 @@ class ImportStatement(metaclass=PoolMeta):
     def precargadas_origin(self, ccoop_statement, move):
         pool = Pool()
         Origin = pool.get('account.statement.origin')
-
-        origin = Origin()
-        origin.number = move.op_number
-        origin.date = move.date
-        origin.amount = move.debit * -1
-        origin.party = self.precargadas_party(ccoop_statement)
+        return [Origin(**v)
+            for v in self.precargadas_origin_values(ccoop_statement, move)]
+
+    def precargadas_statement_origin_values(self, ccoop_statement):
+        'Return the values of the origins that depend only on the statement'
+        party = self.precargadas_party(ccoop_statement)
+        return {
+            'party': party.id if party else None,
+            'information': self.precargadas_information(ccoop_statement),
+            }
+
+    def precargadas_origin_values(
+            self, ccoop_statement, move, statement_values=None):
+        'Return the list of values of the origins of the move'
+        if statement_values is None:
+            statement_values = self.precargadas_statement_origin_values(
+                ccoop_statement)
         description = move.description1 and move.description1 + ' - ' or ''
-        origin.description = description + move.description2
-        origin.information = self.precargadas_information(ccoop_statement)
-        return [origin]
+        return [dict(statement_values,
+                number=move.op_number,
+                date=move.date,
+                amount=move.debit * -1,
+                description=description + move.description2,
+                )]
 
     def precargadas_party(self, ccoop_statement):
         pool = Pool()
         Identifier = pool.get('party.identifier')
+        Party = pool.get('party.party')
 
-        identifiers = Identifier.search([
-            ('type', '=', 'ar_tarjeta_precargada'),
-            ('code', '=', ccoop_statement.card_number),
-            ])
-        if len(identifiers) == 1:
-            return identifiers[0].party
+        party = Identifier.get_precargada_party(ccoop_statement.card_number)
+        if party is not None:
+            return Party(party)
 
     def precargadas_information(self, ccoop_statement):
         information = {}
@@ -275,7 +919,8 @@ class PreloadedCardLoading(Workflow, ModelSQL, ModelView):
     currency = fields.Function(fields.Many2One('currency.currency',
         'Currency'), 'on_change_with_currency')
     total_amount = fields.Function(fields.Numeric('Total Amount',
-        digits=(16, 2)), 'on_change_with_total_amount')
+        digits=(16, 2)), 'get_total_amount',
+        searcher='search_total_amount')
     lines = fields.One2Many('account.preloaded_card.loading.line',
         'card_loading', 'Lines',
         context={'company': Eval('company', -1)},
@@ -288,6 +933,8 @@ class PreloadedCardLoading(Workflow, ModelSQL, ModelView):
     move = fields.Many2One('account.move', 'Move', readonly=True)
     cancel_move = fields.Many2One('account.move', 'Cancel Move', readonly=True,
         states={'invisible': ~Eval('cancel_move')})
+    profile = fields.Dict(None, 'Profile', readonly=True,
+        help='The time, queries and rows of the last post and cancel stages.')
 
     del _states, _depends
 
@@ -313,6 +960,9 @@ class PreloadedCardLoading(Workflow, ModelSQL, ModelView):
                 'depends': ['state'],
                 },
             })
+        cls.__rpc__.update({
+                'post_batch': RPC(readonly=False, instantiate=0),
+                })
 
     @staticmethod
     def default_company():
@@ -339,6 +989,67 @@ class PreloadedCardLoading(Workflow, ModelSQL, ModelView):
             total += line.amount or Decimal(0)
         return total
 
+    @classmethod
+    def get_total_amount(cls, card_loadings, name):
+        pool = Pool()
+        Line = pool.get('account.preloaded_card.loading.line')
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        amounts = dict.fromkeys(map(int, card_loadings), Decimal(0))
+        for sub_ids in grouped_slice(amounts.keys()):
+            cursor.execute(*line.select(line.card_loading, Sum(line.amount),
+                    where=reduce_ids(line.card_loading, sub_ids),
+                    group_by=line.card_loading))
+            for card_loading, amount in cursor:
+                # SQLite uses float for sum
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                amounts[card_loading] = amount.quantize(Decimal('0.01'))
+        return amounts
+
+    @classmethod
+    def _total_amount_query(cls):
+        pool = Pool()
+        Line = pool.get('account.preloaded_card.loading.line')
+        table = cls.__table__()
+        line = Line.__table__()
+        type_name = cls.total_amount._field.sql_type().base
+
+        return table.join(line, 'LEFT',
+            condition=line.card_loading == table.id
+            ).select(table.id.as_('card_loading'),
+                Coalesce(Sum(line.amount), 0).cast(type_name).as_(
+                    'total_amount'),
+                group_by=table.id)
+
+    @classmethod
+    def search_total_amount(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        # SQLite uses float for sum
+        if value is not None and backend.name == 'sqlite':
+            if operator in {'in', 'not in'}:
+                value = [float(v) for v in value]
+            else:
+                value = float(value)
+
+        query = cls._total_amount_query()
+        query = query.select(query.card_loading,
+            where=Operator(query.total_amount, value))
+        return [('id', 'in', query)]
+
+    @classmethod
+    def order_total_amount(cls, tables):
+        table, _ = tables[None]
+        if 'total_amount' not in tables:
+            query = cls._total_amount_query()
+            tables['total_amount'] = {
+                None: (query, query.card_loading == table.id),
+                }
+        query, _ = tables['total_amount'][None]
+        return [query.total_amount]
+
     @classmethod
     def delete(cls, card_loadings):
         for card_loading in card_loadings:
@@ -347,6 +1058,116 @@ class PreloadedCardLoading(Workflow, ModelSQL, ModelView):
                     'account_statement_credicoop.msg_card_loading_delete'))
         super().delete(card_loadings)
 
+    def _get_active_parties(self):
+        '''Return the ids of the active parties in the order of the lines
+        or None if they are unknown'''
+        return None
+
+    def add_lines(self):
+        'Fill the lines with the active parties'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Identifier = pool.get('party.identifier')
+        CardLoadingLine = pool.get('account.preloaded_card.loading.line')
+
+        if (not self.credit_account or not self.debit_account or
+                not self.journal):
+            self.lines = []
+            return
+
+        if self.lines:
+            return
+
+        parties = self._get_active_parties()
+        if parties is None:
+            return
+        lines = []
+        # Browse by slices as each instance searches its id in the ids
+        for sub_parties in grouped_slice(parties):
+            for party in Party.browse(sub_parties):
+                lines.append(CardLoadingLine(
+                        party=party,
+                        card_number=(
+                            Identifier.get_precargada_card_number(party)),
+                        amount=Decimal(0)))
+        self.lines = lines
+
+    def get_previous(self):
+        'Return the last posted card loading of the journal'
+        loadings = self.search([
+                ('company', '=', self.company.id),
+                ('journal', '=', self.journal.id),
+                ('state', '=', 'posted'),
+                ('id', '!=', self.id),
+                ], order=[('date', 'DESC'), ('id', 'DESC')], limit=1)
+        if loadings:
+            return loadings[0]
+
+    @classmethod
+    @ModelView.button
+    def generate_from_previous(cls, card_loadings):
+        '''Replace the lines by a copy of those of the previous card loading
+        of the journal and apply the changes of the active parties
+        and of their card numbers
+        '''
+        pool = Pool()
+        CardLoadingLine = pool.get('account.preloaded_card.loading.line')
+        Identifier = pool.get('party.identifier')
+
+        for card_loading in card_loadings:
+            if card_loading.state != 'draft':
+                raise UserError(gettext(
+                        'account_statement_credicoop'
+                        '.msg_card_loading_generate_draft',
+                        card_loading=card_loading.rec_name))
+
+        to_delete, to_write, to_create = [], [], []
+        for card_loading in card_loadings:
+            previous = card_loading.get_previous()
+            if not previous:
+                raise UserError(gettext(
+                        'account_statement_credicoop'
+                        '.msg_card_loading_no_previous',
+                        card_loading=card_loading.rec_name))
+            CardLoadingLine.delete(card_loading.lines)
+            lines = CardLoadingLine.copy(previous.lines, default={
+                    'card_loading': card_loading.id,
+                    })
+
+            # Without active parties, the parties of the lines are kept
+            parties = card_loading._get_active_parties()
+            active = set(parties) if parties is not None else None
+            loaded = set()
+            for line in lines:
+                if not line.party:
+                    continue
+                party = line.party.id
+                if active is not None and party not in active:
+                    to_delete.append(line)
+                    continue
+                loaded.add(party)
+                card_number = Identifier.get_precargada_card_number(party)
+                if card_number and card_number != line.card_number:
+                    to_write.extend(([line], {
+                                'card_number': card_number,
+                                }))
+            for party in parties or []:
+                if party not in loaded:
+                    loaded.add(party)
+                    to_create.append({
+                            'card_loading': card_loading.id,
+                            'party': party,
+                            'card_number': (
+                                Identifier.get_precargada_card_number(party)),
+                            'amount': Decimal(0),
+                            })
+        if to_delete:
+            CardLoadingLine.delete(to_delete)
+        if to_write:
+            CardLoadingLine.write(*to_write)
+        if to_create:
+            CardLoadingLine.create(to_create)
+
     @classmethod
     @ModelView.button
     @Workflow.transition('posted')
@@ -354,28 +1175,133 @@ class PreloadedCardLoading(Workflow, ModelSQL, ModelView):
         pool = Pool()
         Move = pool.get('account.move')
 
-        moves = []
+        with Profiler('account.preloaded_card.loading.post') as profiler:
+            periods = PeriodCache()
+            with profiler.stage('moves', rows=len(card_loadings)):
+                moves = [c.get_move(periods=periods) for c in card_loadings]
+            if moves:
+                with profiler.stage('save_moves', rows=len(moves)):
+                    Move.save(moves)
+                with profiler.stage('post_moves', rows=len(moves)):
+                    Move.post(moves)
+
+            to_write = []
+            for card_loading, move in zip(card_loadings, moves):
+                to_write.extend(([card_loading], {
+                            'move': move.id,
+                            }))
+            with profiler.stage('write', rows=len(card_loadings)):
+                if to_write:
+                    cls.write(*to_write)
+        if profiler.enabled:
+            cls._write_profile(card_loadings, 'post', profiler)
+
+    @classmethod
+    def post_batch(cls, card_loadings, max_workers=None):
+        '''Post the draft card loadings by company and journal
+        each partition in its own transaction and thread
+
+        Return the list of company id, journal id and error message of
+        the partitions that failed, the others are committed.
+        '''
+        transaction = Transaction()
+        cls._check_post_access(card_loadings)
+        partitions = cls._post_partitions(card_loadings)
+        if not partitions:
+            return []
+        # The workers requested by the client are limited by the server
+        post_workers = config.getint(
+            'account_statement_credicoop', 'post_workers', default=4)
+        max_workers = max(min(max_workers or post_workers, post_workers), 1)
+        if backend.name == 'sqlite':
+            # SQLite serializes the writing transactions
+            max_workers = 1
+        # The post button checks the access again in the partitions
+        args = (transaction.database.name, transaction.user,
+            dict(transaction.context))
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=max_workers,
+                thread_name_prefix='card-loading-post') as executor:
+            futures = {
+                executor.submit(cls._post_partition, *args, ids): key
+                for key, ids in partitions.items()}
+            for future in as_completed(futures):
+                company, journal = futures[future]
+                try:
+                    future.result()
+                except Exception as exception:
+                    logger.error(
+                        'post of card loadings of company %s '
+                        'and journal %s failed', company, journal,
+                        exc_info=True)
+                    errors.append((company, journal, str(exception)))
+        return sorted(errors)
+
+    @classmethod
+    def _check_post_access(cls, card_loadings):
+        'Check the access of the user to the post button of the card loadings'
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        Button = pool.get('ir.model.button')
+        User = pool.get('res.user')
+        transaction = Transaction()
+
+        if not transaction.user or not transaction.context.get(
+                '_check_access'):
+            return
+        ModelAccess.check(cls.__name__, 'read')
+        # Check the record rules
+        cls.read([c.id for c in card_loadings], ['id'])
+        button_groups = Button.get_groups(cls.__name__, 'post')
+        if button_groups:
+            if not set(User.get_groups()) & button_groups:
+                raise AccessButtonError(gettext(
+                        'ir.msg_access_button_error',
+                        button='post', model=cls.__name__))
+        else:
+            ModelAccess.check(cls.__name__, 'write')
+
+    @classmethod
+    def _post_partitions(cls, card_loadings):
+        'Return the ids of the draft card loadings by company and journal'
+        partitions = {}
         for card_loading in card_loadings:
-            move = card_loading.get_move()
-            card_loading.move = move
-            card_loading.save()
-            moves.append(move)
+            if card_loading.state != 'draft':
+                continue
+            key = (card_loading.company.id, card_loading.journal.id)
+            partitions.setdefault(key, []).append(card_loading.id)
+        return partitions
+
+    @classmethod
+    def _post_partition(cls, database_name, user, context, ids):
+        with Transaction(new=True).start(
+                database_name, user, context=context):
+            CardLoading = Pool().get(cls.__name__)
+            CardLoading.post([c for c in CardLoading.browse(ids)
+                    if c.state == 'draft'])
 
-        if moves:
-            Move.save(moves)
-            Move.post(moves)
+    @classmethod
+    def _write_profile(cls, card_loadings, name, profiler):
+        cls.write(*sum((([c], {
+                            'profile': dict(c.profile or {},
+                                **{name: profiler.summary()}),
+                            }) for c in card_loadings), ()))
 
-    def get_move(self):
+    def get_move(self, periods=None):
         pool = Pool()
-        Period = pool.get('account.period')
         Move = pool.get('account.move')
         MoveLine = pool.get('account.move.line')
 
+        if periods is None:
+            periods = PeriodCache()
         accounting_date = self.date
-        period_id = Period.find(self.company.id, date=accounting_date)
+        period_id, _ = periods.find(self.company, accounting_date)
 
+        total_amount = Decimal(0)
         move_lines = []
         for line in self.lines:
+            total_amount += line.amount or Decimal(0)
             move_line = MoveLine()
             move_line.amount_second_currency = None
             move_line.second_currency = None
@@ -391,7 +1317,7 @@ class PreloadedCardLoading(Workflow, ModelSQL, ModelView):
         move_line.amount_second_currency = None
         move_line.second_currency = None
         move_line.debit = 0
-        move_line.credit = self.total_amount
+        move_line.credit = total_amount
         move_line.account = self.credit_account
         move_line.maturity_date = self.date
         move_line.description = self.description
@@ -414,17 +1340,27 @@ class PreloadedCardLoading(Workflow, ModelSQL, ModelView):
         pool = Pool()
         Move = pool.get('account.move')
 
-        cancel_moves = []
-        for card_loading in card_loadings:
-            if card_loading.move:
-                move = card_loading.move.cancel()
-                card_loading.cancel_move = move
-                card_loading.save()
-                cancel_moves.append(move)
-
-        if cancel_moves:
-            Move.save(cancel_moves)
-            Move.post(cancel_moves)
+        with Profiler('account.preloaded_card.loading.cancel') as profiler:
+            cancel_moves = []
+            to_write = []
+            with profiler.stage('cancel_moves'):
+                for card_loading in card_loadings:
+                    if card_loading.move:
+                        move = card_loading.move.cancel()
+                        cancel_moves.append(move)
+                        to_write.extend(([card_loading], {
+                                    'cancel_move': move.id,
+                                    }))
+            profiler.add_rows('cancel_moves', len(cancel_moves))
+
+            if cancel_moves:
+                with profiler.stage('post_moves', rows=len(cancel_moves)):
+                    Move.post(cancel_moves)
+            with profiler.stage('write', rows=len(to_write) // 2):
+                if to_write:
+                    cls.write(*to_write)
+        if profiler.enabled:
+            cls._write_profile(card_loadings, 'cancel', profiler)
 
     @classmethod
     @ModelView.button_action(
@@ -440,6 +1376,7 @@ class PreloadedCardLoading(Workflow, ModelSQL, ModelView):
             default = default.copy()
         default.setdefault('move', None)
         default.setdefault('cancel_move', None)
+        default.setdefault('profile', None)
         return super().copy(card_loadings, default=default)
 
 
@@ -458,39 +1395,27 @@ class PreloadedCardLoading2(metaclass=PoolMeta):
     def on_change_journal(self):
         self.add_lines()
 
-    def add_lines(self):
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._buttons.update({
+                'generate_from_previous': {
+                    'invisible': Eval('state') != 'draft',
+                    'depends': ['state'],
+                    },
+                })
+
+    def _get_active_parties(self):
         pool = Pool()
         Partner = pool.get('cooperative.partner')
-        CardLoadingLine = pool.get('account.preloaded_card.loading.line')
-        Identifier = pool.get('party.identifier')
-
-        lines = []
-        if (not self.credit_account or not self.debit_account or
-                not self.journal):
-            self.lines = lines
-            return
+        partner = Partner.__table__()
+        cursor = Transaction().connection.cursor()
 
-        if self.lines:
-            return
-
-        partners = Partner.search([('status', '=', 'active')],
-            order=[('file', 'ASC')])
-        for partner in partners:
-            card_number = None
-            identifiers = Identifier.search([
-                ('party', '=', partner.party),
-                ('type', '=', 'ar_tarjeta_precargada'),
-                ])
-            if len(identifiers) == 1:
-                card_number = identifiers[0].code
-
-            line = CardLoadingLine()
-            line.party = partner.party
-            line.card_number = card_number
-            line.amount = Decimal(0)
-            lines.append(line)
-
-        self.lines = lines
+        partners = Partner.search([('status', '=', 'active')], query=True)
+        cursor.execute(*partner.select(partner.party,
+                where=partner.id.in_(partners),
+                order_by=[partner.file.asc, partner.id.asc]))
+        return [p for p, in cursor]
 
 
 class PreloadedCardLoadingLine(ModelSQL, ModelView):
@@ -514,58 +1439,106 @@ class PreloadedCardLoadingLine(ModelSQL, ModelView):
         ('draft', 'Draft'),
         ('posted', 'Posted'),
         ('cancelled', 'Cancelled'),
-        ], 'State'), 'get_parent_field')
+        ], 'State'), 'get_parent_field', searcher='search_state')
 
     del _states, _depends
 
     @classmethod
     def get_parent_field(cls, lines, names):
-        result = {}
-        for name in names:
-            result[name] = {}
-            if cls._fields[name]._type == 'many2one':
-                for l in lines:
-                    field = getattr(l.card_loading, name, None)
-                    result[name][l.id] = field.id if field else None
-            else:
-                for l in lines:
-                    result[name][l.id] = getattr(l.card_loading, name, None)
+        pool = Pool()
+        CardLoading = pool.get('account.preloaded_card.loading')
+        Company = pool.get('company.company')
+        line = cls.__table__()
+        card_loading = CardLoading.__table__()
+        company = Company.__table__()
+        cursor = Transaction().connection.cursor()
+
+        columns = {
+            'currency': company.currency,
+            'state': card_loading.state,
+            }
+        result = {n: {} for n in names}
+        for sub_ids in grouped_slice(list(map(int, lines))):
+            cursor.execute(*line.join(card_loading,
+                    condition=line.card_loading == card_loading.id
+                    ).join(company,
+                    condition=card_loading.company == company.id
+                    ).select(line.id, *(columns[n] for n in names),
+                    where=reduce_ids(line.id, sub_ids)))
+            for line_id, *values in cursor:
+                for name, value in zip(names, values):
+                    result[name][line_id] = value
         return result
 
+    @classmethod
+    def search_state(cls, name, clause):
+        return [('card_loading.state',) + tuple(clause[1:])]
+
 
 class PreloadedCardLoadingReport(Report):
     'Preloaded Card Loading Report'
     __name__ = 'account.preloaded_card.loading.report'
 
+    _template = 'account_statement_credicoop/preloaded_card_loading.txt'
+
+    @classmethod
+    def _execute(cls, records, header, data, action):
+        # The fixed-width file is written from the lines read in SQL
+        # as rendering preloaded_card_loading.txt is too slow for big loadings
+        # but a customized template is still rendered
+        if action.report_content_custom or action.report != cls._template:
+            return super()._execute(records, header, data, action)
+        content = StringIO()
+        content.writelines(cls.get_lines(data['ids']))
+        return action.template_extension, content.getvalue()
+
     @classmethod
     def get_context(cls, records, header, data):
         pool = Pool()
         CardLoading = pool.get('account.preloaded_card.loading')
 
-        def justify(string, size):
-            return string.ljust(size)
-            # return string[:size]
-
-        def format_decimal(n):
-            if not isinstance(n, Decimal):
-                n = Decimal(n)
-            return ('{0:.2f}'.format(abs(n))).replace('.', '').rjust(9, '0')
-
-        def strip_accents(s):
-            return ''.join(c for c in unicode_normalize('NFD', s)
-                if unicode_category(c) != 'Mn')
-
         context = super().get_context(records, header, data)
-
         context['records'] = []
         for record in CardLoading.browse(data['ids']):
             for line in record.lines:
                 context['records'].append({
-                    'card_number': line.card_number,
+                    'card_number': line.card_number or '',
                     'amount': line.amount,
-                    'description': record.description,
+                    'description': record.description or '',
                     })
         context['justify'] = justify
-        context['format_decimal'] = format_decimal
+        context['format_decimal'] = format_amount
         context['strip_accents'] = strip_accents
         return context
+
+    @classmethod
+    def get_lines(cls, ids):
+        'Yield the lines of the file for the card loading ids'
+        pool = Pool()
+        CardLoading = pool.get('account.preloaded_card.loading')
+        Line = pool.get('account.preloaded_card.loading.line')
+        card_loading = CardLoading.__table__()
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            # Keep the order of the ids
+            sequence = Case(*((card_loading.id == id_, i)
+                    for i, id_ in enumerate(sub_ids)))
+            cursor.execute(*line.join(card_loading,
+                    condition=line.card_loading == card_loading.id
+                    ).select(
+                    line.card_number, line.amount, card_loading.description,
+                    where=reduce_ids(card_loading.id, sub_ids),
+                    order_by=[sequence, line.id]))
+            for card_number, amount, description in cursor:
+                yield cls.format_line(card_number, amount, description)
+
+    @classmethod
+    def format_line(cls, card_number, amount, description):
+        return '%s%s%s\r\n' % (
+            card_number or '',
+            format_amount(amount),
+            format_description(description))
+
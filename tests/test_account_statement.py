@@ -1,18 +1,1214 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import csv
+import io
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+import zipfile
+from collections import namedtuple
+from datetime import date
+from decimal import Decimal
+from unittest.mock import patch
 
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.model.exceptions import AccessButtonError, AccessError
+from trytond.pool import Pool
+from trytond.tools import file_open
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import suite as test_suite
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_statement_credicoop.credicoop_precargadas \
+    import Precargadas, Statement, Move, MoveStore, MOVE, parse_files
+from trytond.modules.account_statement_credicoop.instrumentation import (
+    QueryCounter)
+from trytond.modules.account_statement_credicoop.credicoop_format import (
+    strip_accents, format_amount, format_description)
+
+PRECARGADAS = os.path.join(os.path.dirname(__file__), 'precargadas.csv')
+
+
+def create_fiscalyear(company):
+    fiscalyear = get_fiscalyear(company, today=date(2021, 6, 1))
+    fiscalyear.save()
+    fiscalyear.create_period([fiscalyear])
+    return fiscalyear
+
+
+def create_statement_journal(company, number):
+    pool = Pool()
+    Account = pool.get('account.account')
+    Journal = pool.get('account.journal')
+    Party = pool.get('party.party')
+    Bank = pool.get('bank')
+    BankAccount = pool.get('bank.account')
+    StatementJournal = pool.get('account.statement.journal')
+
+    cash, = Account.search([
+            ('company', '=', company.id),
+            ('name', '=', 'Main Cash'),
+            ])
+    cash_journal, = Journal.search([('type', '=', 'cash')], limit=1)
+    journal, = Journal.copy([cash_journal], default={
+            'name': 'Statement',
+            'type': 'statement',
+            })
+    bank = Bank(party=Party(name='Credicoop'))
+    bank.party.save()
+    bank.save()
+    bank_account = BankAccount(
+        bank=bank, currency=company.currency, owners=[company.party],
+        numbers=[{'type': 'other', 'number': number}])
+    bank_account.save()
+    statement_journal = StatementJournal(
+        name='Precargadas', journal=journal, account=cash,
+        currency=company.currency, company=company,
+        validation='balance', bank_account=bank_account)
+    statement_journal.save()
+    return statement_journal
 
 
 class AccountStatementTestCase(ModuleTestCase):
     'Test account_statement_credicoop module'
     module = 'account_statement_credicoop'
 
+    def import_precargadas(self, company, data):
+        pool = Pool()
+        Statement = pool.get('account.statement')
+        ImportStatement = pool.get(
+            'account.statement.import', type='wizard')
+
+        session_id, _, _ = ImportStatement.create()
+        import_statement = ImportStatement(session_id)
+        import_statement.start.company = company
+        import_statement.start.file_format = 'credicoop_precargadas'
+        import_statement.start.file_ = data
+        statements = list(import_statement.parse_credicoop_precargadas())
+        Statement.save(statements)
+        return statements
+
+    @with_transaction()
+    def test_import_precargadas(self):
+        'Test import Credicoop Precargadas'
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            create_statement_journal(company, '4000-1234-5678-9010')
+            party = Party(name='Cardholder', identifiers=[{
+                        'type': 'ar_tarjeta_precargada',
+                        'code': '4000-1234-5678-9010',
+                        }])
+            party.save()
+            with open(PRECARGADAS, 'rb') as f:
+                data = f.read()
+
+            statement, = self.import_precargadas(company, data)
+
+            self.assertEqual(
+                [o.number for o in statement.origins],
+                ['100245', '100302', '100355'])
+            self.assertEqual(statement.number_of_lines, 3)
+            self.assertEqual(statement.end_balance, Decimal('-7734.66'))
+            self.assertEqual(statement.origins[0].information, {
+                    'credicoop_precargadas_card_number':
+                    '4000-1234-5678-9010',
+                    })
+            self.assertEqual(statement.origins[0].party, party)
+
+            # The same file is not imported again
+            self.assertEqual(self.import_precargadas(company, data), [])
+
+            # Only the rows of the statement not imported are checked
+            data = data.replace(b',,,Total', (
+                    ',29/11/2021,100420,COMPRA,Kiosco,,Compra en comercio,,'
+                    '"15,00",,,,"0,00"\r\n,,,Total').encode('windows-1252'))
+            with Transaction().set_context(credicoop_profile=True):
+                statement, = self.import_precargadas(company, data)
+
+            self.assertEqual(
+                [o.number for o in statement.origins], ['100420'])
+            self.assertEqual(
+                statement.profile['import']['stages']['deduplicate']['rows'],
+                1)
+
+            # The rows are checked if the imported ones changed
+            data = data.replace(b'Combustible', b'Nafta')
+            with Transaction().set_context(credicoop_profile=True):
+                statement, = self.import_precargadas(company, data)
+
+            self.assertEqual(statement.origins, ())
+            self.assertEqual(
+                statement.profile['import']['stages']['deduplicate']['rows'],
+                4)
+
+    @with_transaction()
+    def test_import_precargadas_zip(self):
+        'Test import Credicoop Precargadas from a zip archive'
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            create_statement_journal(company, '4000-1234-5678-9010')
+            create_statement_journal(company, '4000-1234-5678-9011')
+            with open(PRECARGADAS, 'rb') as f:
+                data = f.read()
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w') as z:
+                z.writestr('9010.csv', data)
+                z.writestr('9011.csv', data
+                    .replace(b'9010', b'9011')
+                    .replace(b',100', b',200'))
+
+            statements = self.import_precargadas(company, archive.getvalue())
+
+            self.assertEqual(
+                [s.journal.bank_account.numbers[0].number
+                    for s in statements],
+                ['4000-1234-5678-9010', '4000-1234-5678-9011'])
+            self.assertEqual(
+                [[o.number for o in s.origins] for s in statements],
+                [['100245', '100302', '100355'],
+                    ['200245', '200302', '200355']])
+
+            # The archive is not parsed again
+            with patch('trytond.modules.account_statement_credicoop.'
+                    'statement.parse_files') as parse_files:
+                self.assertEqual(
+                    self.import_precargadas(company, archive.getvalue()), [])
+            parse_files.assert_not_called()
+
+    @with_transaction()
+    def test_import_precargadas_multiple(self):
+        'Test import Credicoop Precargadas file of many cards'
+        pool = Pool()
+        Statement = pool.get('account.statement')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            create_statement_journal(company, '4000-1234-5678-9010')
+            create_statement_journal(company, '4000-1234-5678-9011')
+            with open(PRECARGADAS, 'rb') as f:
+                data = f.read()
+            data += (data
+                .replace(b'9010', b'9011')
+                .replace(b',100', b',200'))
+
+            statements = self.import_precargadas(company, data)
+
+            self.assertEqual(
+                [s.journal.bank_account.numbers[0].number
+                    for s in statements],
+                ['4000-1234-5678-9010', '4000-1234-5678-9011'])
+            self.assertEqual(
+                [[o.number for o in s.origins] for s in statements],
+                [['100245', '100302', '100355'],
+                    ['200245', '200302', '200355']])
+            self.assertEqual(self.import_precargadas(company, data), [])
+
+            # The statements deleted are imported again
+            Statement.delete(statements[1:])
+            statements = self.import_precargadas(company, data)
+
+            self.assertEqual(
+                [[o.number for o in s.origins] for s in statements],
+                [[], ['200245', '200302', '200355']])
+
+    @with_transaction()
+    def test_import_precargadas_resume(self):
+        'Test resume a chunked import of Credicoop Precargadas'
+        pool = Pool()
+        Checkpoint = pool.get('account.statement.import.checkpoint')
+
+        class Interrupted(Exception):
+            pass
+
+        commits = []
+
+        def commit(transaction):
+            commits.append(len(commits))
+            if len(commits) == 2:
+                raise Interrupted
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            create_statement_journal(company, '4000-1234-5678-9010')
+            with open(PRECARGADAS, 'rb') as f:
+                data = f.read()
+
+            if not config.has_section('account_statement_credicoop'):
+                config.add_section('account_statement_credicoop')
+            config.set('account_statement_credicoop', 'import_chunk', '2')
+            try:
+                with patch.object(Transaction, 'commit', commit):
+                    with self.assertRaises(Interrupted):
+                        self.import_precargadas(company, data)
+                    checkpoint, = Checkpoint.search([])
+                    self.assertEqual(checkpoint.state, 'running')
+                    self.assertEqual(checkpoint.rows, 4)
+                    self.assertEqual(checkpoint.last_number, '100355')
+
+                    statement, = self.import_precargadas(company, data)
+            finally:
+                config.remove_option(
+                    'account_statement_credicoop', 'import_chunk')
+
+            self.assertEqual(statement, checkpoint.statement)
+            self.assertEqual(
+                [o.number for o in statement.origins],
+                ['100245', '100302', '100355'])
+            self.assertEqual(statement.number_of_lines, 3)
+            self.assertEqual(statement.end_balance, Decimal('-7734.66'))
+            self.assertEqual(checkpoint.state, 'done')
+            self.assertEqual(checkpoint.rows, 5)
+            self.assertEqual(len(commits), 3)
+
+    @with_transaction()
+    def test_import_precargadas_background(self):
+        'Test import Credicoop Precargadas in the background'
+        pool = Pool()
+        Job = pool.get('account.statement.import.job')
+        Checkpoint = pool.get('account.statement.import.checkpoint')
+        ImportStatement = pool.get(
+            'account.statement.import', type='wizard')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            create_statement_journal(company, '4000-1234-5678-9010')
+            with open(PRECARGADAS, 'rb') as f:
+                data = f.read()
+
+            session_id, _, _ = ImportStatement.create()
+            import_statement = ImportStatement(session_id)
+            import_statement.start.company = company
+            import_statement.start.file_format = 'credicoop_precargadas'
+            import_statement.start.file_ = data
+            import_statement.start.credicoop_background = True
+            with patch.object(Transaction, 'atexit') as atexit:
+                action, data_ = import_statement.do_import_(
+                    import_statement.import_.get_action())
+
+            self.assertEqual(action['res_model'], Job.__name__)
+            job, = Job.browse(data_['res_id'])
+            self.assertEqual(job.state, 'waiting')
+            self.assertEqual(job.file_hash, Checkpoint.hash(data))
+            self.assertEqual(atexit.call_count, 1)
+
+            with patch.object(Transaction, 'commit'):
+                Job.process([job])
+
+            job = Job(job.id)
+            self.assertEqual(job.state, 'done')
+            self.assertEqual(
+                (job.parsed, job.skipped, job.imported), (5, 0, 3))
+            statement, = job.statements
+            self.assertEqual(statement.number_of_lines, 3)
+            self.assertEqual(statement.origin_file, data)
+
+            # The cron processes the jobs waiting for longer than the delay
+            job, = Job.create([{
+                        'company': company.id,
+                        'file_': data,
+                        'file_format': 'credicoop_precargadas',
+                        }])
+            # and resumes those interrupted while running
+            running, = Job.create([{
+                        'company': company.id,
+                        'file_': data,
+                        'file_format': 'credicoop_precargadas',
+                        }])
+            Job.run([running])
+            with patch.object(Transaction, 'commit'):
+                Job.process_waiting()
+            self.assertEqual(Job(job.id).state, 'waiting')
+            self.assertEqual(Job(running.id).state, 'running')
+
+            if not config.has_section('account_statement_credicoop'):
+                config.add_section('account_statement_credicoop')
+            config.set(
+                'account_statement_credicoop', 'import_job_delay', '0')
+            try:
+                with patch.object(Transaction, 'commit'):
+                    Job.process_waiting()
+            finally:
+                config.remove_option(
+                    'account_statement_credicoop', 'import_job_delay')
+            self.assertEqual(Job(job.id).state, 'done')
+            self.assertEqual(Job(running.id).state, 'done')
+
+    @with_transaction(context={'credicoop_profile': True})
+    def test_import_precargadas_profile(self):
+        'Test profile of the Credicoop Precargadas import'
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            create_statement_journal(company, '4000-1234-5678-9010')
+            with open(PRECARGADAS, 'rb') as f:
+                data = f.read()
+
+            statement, = self.import_precargadas(company, data)
+
+            stages = statement.profile['import']['stages']
+            self.assertEqual(stages['parse']['rows'], 5)
+            self.assertEqual(stages['origins']['rows'], 3)
+            self.assertEqual(stages['origins']['queries'], 0)
+            self.assertEqual(stages['create']['rows'], 3)
+            self.assertGreater(stages['deduplicate']['queries'], 0)
+            self.assertGreaterEqual(
+                statement.profile['import']['queries'],
+                sum(s['queries'] for s in stages.values()))
+
+    @with_transaction()
+    def test_query_counter(self):
+        'Test count the queries of the transaction'
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        with QueryCounter() as outer:
+            cursor.execute('SELECT 1')
+            with QueryCounter() as inner:
+                cursor.execute('SELECT 2')
+            cursor.execute('SELECT 3')
+        cursor.execute('SELECT 4')
+        self.assertEqual((outer.count, inner.count), (3, 1))
+
+        # Connections without trace callback count with their cursors
+        class Cursor(object):
+            def execute(self, sql, args=None):
+                pass
+
+        class Connection(object):
+            cursor_factory = Cursor
+
+            def cursor(self):
+                return self.cursor_factory()
+
+        connection = Connection()
+        with patch.object(transaction, 'connection', connection):
+            with QueryCounter() as outer:
+                connection.cursor().execute('SELECT 1')
+                with QueryCounter() as inner:
+                    connection.cursor().execute('SELECT 2')
+            connection.cursor().execute('SELECT 3')
+        self.assertEqual((outer.count, inner.count), (2, 1))
+        self.assertIs(connection.cursor_factory, Cursor)
+
+    @with_transaction()
+    def test_group_lines_by_account_period(self):
+        'Test group lines by account and period'
+        pool = Pool()
+        Statement = pool.get('account.statement')
+        Account = pool.get('account.account')
+        Line = namedtuple('Line', ['account', 'date'])
+
+        account1, account2 = Account(1), Account(2)
+        lines = [
+            Line(account2, date(2021, 1, 5)),
+            Line(account1, date(2021, 1, 10)),
+            Line(account2, date(2021, 2, 1)),
+            Line(account1, date(2021, 1, 31)),
+            Line(account2, date(2021, 1, 20)),
+            ]
+
+        groups = Statement()._group_lines_by_account_period(lines)
+
+        self.assertEqual([(dict(k)['account'], dict(k)['date'], len(l))
+                for k, l in groups], [
+                (account1, (2021, 1), 2),
+                (account2, (2021, 1), 2),
+                (account2, (2021, 2), 1),
+                ])
+        self.assertEqual(
+            Statement()._group_lines_by_account_period(reversed(lines)),
+            [(k, l[::-1]) for k, l in groups])
+
+    @with_transaction()
+    def test_create_move_group_by_account(self):
+        'Test create move grouped by account and period'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Statement = pool.get('account.statement')
+        Line = pool.get('account.statement.line')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            journal = create_statement_journal(company, '1234')
+            journal.group_moves_by_account = True
+            journal.save()
+            revenue, = Account.search([
+                    ('company', '=', company.id),
+                    ('type.revenue', '=', True),
+                    ])
+            expense, = Account.search([
+                    ('company', '=', company.id),
+                    ('type.expense', '=', True),
+                    ])
+            lines = []
+            for i, (account, month) in enumerate([
+                        (expense, 1), (revenue, 1), (expense, 1),
+                        (expense, 2), (revenue, 1), (expense, 1),
+                        ], 1):
+                lines.append({
+                        'date': date(2021, month, i),
+                        'amount': Decimal(-10 * i),
+                        'account': account.id,
+                        })
+            statement, = Statement.create([{
+                        'name': 'Test',
+                        'company': company.id,
+                        'journal': journal.id,
+                        'date': date(2021, 2, 28),
+                        'start_balance': Decimal(0),
+                        'end_balance': Decimal(-210),
+                        'lines': [('create', lines)],
+                        }])
+
+            with Transaction().set_context(credicoop_profile=True), \
+                    patch.object(Line, 'get_move_line', autospec=True,
+                        side_effect=Line.get_move_line) as get_move_line:
+                moves = Statement.create_move([statement])
+
+            self.assertEqual(get_move_line.call_count, 6)
+            self.assertEqual(len(moves), 3)
+            self.assertEqual(
+                [(l[0].account, m.date, len(l)) for m, _, l in moves],
+                sorted([
+                        (expense, date(2021, 1, 31), 3),
+                        (expense, date(2021, 2, 28), 1),
+                        (revenue, date(2021, 1, 31), 2),
+                        ], key=lambda m: (m[0].id, m[1])))
+            self.assertEqual(
+                sum(len(m.lines) for m, _, _ in moves), 6 + 3)
+            self.assertEqual(
+                {(l.debit, l.credit, l.account)
+                    for m, _, _ in moves for l in m.lines
+                    if l.account != journal.account},
+                {(Decimal(10 * i), Decimal(0), a)
+                    for i, a in enumerate([
+                            expense, revenue, expense,
+                            expense, revenue, expense], 1)})
+            self.assertTrue(all(l.move for l in statement.lines))
+            stages = statement.profile['create_move']['stages']
+            self.assertEqual(stages['move_lines']['queries'], 0)
+            self.assertEqual(stages['move_lines']['rows'], 6 + 3)
+
+    @with_transaction()
+    def test_card_loading_post_cancel(self):
+        'Test post and cancel preloaded card loadings'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        Party = pool.get('party.party')
+        CardLoading = pool.get('account.preloaded_card.loading')
+        Line = pool.get('account.preloaded_card.loading.line')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            cash, = Account.search([
+                    ('company', '=', company.id),
+                    ('name', '=', 'Main Cash'),
+                    ])
+            receivable, = Account.search([
+                    ('company', '=', company.id),
+                    ('type.receivable', '=', True),
+                    ])
+            journal, = Journal.search([('type', '=', 'cash')], limit=1)
+            party1, party2 = Party.create([
+                    {'name': 'Party 1'}, {'name': 'Party 2'}])
+
+            card_loadings = CardLoading.create([{
+                        'date': date(2021, 6, 10),
+                        'description': 'June %s' % i,
+                        'journal': journal.id,
+                        'credit_account': cash.id,
+                        'debit_account': receivable.id,
+                        'lines': [('create', [{
+                                        'party': party1.id,
+                                        'card_number': '1111',
+                                        'amount': Decimal('100.00'),
+                                        }, {
+                                        'party': party2.id,
+                                        'card_number': '2222',
+                                        'amount': Decimal('50.50') * i,
+                                        }])],
+                        } for i in range(1, 3)])
+
+            CardLoading.post(card_loadings)
+
+            for card_loading, total in zip(card_loadings,
+                    [Decimal('150.50'), Decimal('201.00')]):
+                self.assertEqual(card_loading.state, 'posted')
+                self.assertEqual(card_loading.move.state, 'posted')
+                self.assertEqual(card_loading.move.origin, card_loading)
+                self.assertEqual(len(card_loading.move.lines), 3)
+                self.assertEqual(
+                    sum(l.debit for l in card_loading.move.lines), total)
+                self.assertEqual(
+                    sum(l.credit for l in card_loading.move.lines), total)
+                self.assertEqual(card_loading.total_amount, total)
+            self.assertEqual(CardLoading.search([
+                        ('total_amount', '>', Decimal('200')),
+                        ]), [card_loadings[1]])
+            self.assertEqual(CardLoading.search([
+                        ('total_amount', 'in', [Decimal('150.50')]),
+                        ]), [card_loadings[0]])
+            self.assertEqual(CardLoading.search([],
+                    order=[('total_amount', 'ASC')]), card_loadings)
+            self.assertEqual(
+                {l.state for l in Line.search([('state', '=', 'posted')])},
+                {'posted'})
+            self.assertEqual(
+                len(Line.search([('state', '=', 'posted')])), 4)
+            self.assertEqual(Line.search([('state', '=', 'draft')]), [])
+            self.assertEqual(
+                {l.currency for l in card_loadings[0].lines},
+                {company.currency})
+
+            CardLoading.cancel(card_loadings)
+
+            for card_loading in card_loadings:
+                self.assertEqual(card_loading.state, 'cancelled')
+                self.assertEqual(card_loading.cancel_move.state, 'posted')
+                self.assertEqual(
+                    sum(l.debit for l in card_loading.cancel_move.lines),
+                    -card_loading.total_amount)
+
+    @with_transaction()
+    def test_card_loading_post_batch(self):
+        'Test post preloaded card loadings by company and journal'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        CardLoading = pool.get('account.preloaded_card.loading')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            cash, = Account.search([
+                    ('company', '=', company.id),
+                    ('name', '=', 'Main Cash'),
+                    ])
+            receivable, = Account.search([
+                    ('company', '=', company.id),
+                    ('type.receivable', '=', True),
+                    ])
+            journal1, = Journal.search([('type', '=', 'cash')], limit=1)
+            journal2, = Journal.search([('type', '=', 'revenue')], limit=1)
+
+            card_loadings = CardLoading.create([{
+                        'date': date(2021, 6, 10),
+                        'journal': journal.id,
+                        'credit_account': cash.id,
+                        'debit_account': receivable.id,
+                        } for journal in [journal1, journal2, journal1]])
+            CardLoading.post(card_loadings[-1:])
+
+            partitions = []
+
+            def post_partition(database_name, user, context, ids):
+                partitions.append(ids)
+                if ids == [card_loadings[1].id]:
+                    raise ValueError('failed')
+
+            with patch.object(CardLoading, '_post_partition', post_partition):
+                errors = CardLoading.post_batch(card_loadings)
+
+            self.assertEqual(sorted(partitions), [
+                    [card_loadings[0].id], [card_loadings[1].id]])
+            self.assertEqual(
+                errors, [(company.id, journal2.id, 'failed')])
+
+            # The partition is posted in a new transaction
+            transaction = Transaction()
+            with patch.object(Transaction, 'commit') as commit:
+                CardLoading._post_partition(
+                    transaction.database.name, transaction.user,
+                    transaction.context, [c.id for c in card_loadings])
+            self.assertEqual(commit.call_count, 1)
+            self.assertEqual(
+                [c['state'] for c in CardLoading.read(
+                        [c.id for c in card_loadings], ['state'])],
+                ['posted', 'posted', 'posted'])
+
+    @with_transaction()
+    def test_card_loading_post_batch_access(self):
+        'Test post preloaded card loadings by batch checks the access'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        CardLoading = pool.get('account.preloaded_card.loading')
+        User = pool.get('res.user')
+        Group = pool.get('res.group')
+        Button = pool.get('ir.model.button')
+
+        company = create_company()
+        other_company = create_company(
+            'Other Company', currency=company.currency)
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            cash, = Account.search([
+                    ('company', '=', company.id),
+                    ('name', '=', 'Main Cash'),
+                    ])
+            journal, = Journal.search([('type', '=', 'cash')], limit=1)
+            card_loading, = CardLoading.create([{
+                        'date': date(2021, 6, 10),
+                        'journal': journal.id,
+                        'credit_account': cash.id,
+                        'debit_account': cash.id,
+                        }])
+        user, = User.create([{
+                    'name': 'Poster',
+                    'login': 'poster',
+                    'companies': [('add', [other_company.id])],
+                    'company': other_company.id,
+                    }])
+
+        def post_batch(company):
+            with Transaction().set_user(user.id), \
+                    Transaction().set_context(
+                        company=company.id, _check_access=True):
+                return CardLoading.post_batch(
+                    CardLoading.browse([card_loading.id]))
+
+        # The card loading is not in the companies of the user
+        with self.assertRaises(AccessError):
+            post_batch(other_company)
+
+        User.write([user], {
+                'companies': [('add', [company.id])],
+                'company': company.id,
+                })
+        group, = Group.create([{'name': 'Post Card Loadings'}])
+        button, = Button.search([
+                ('model.model', '=', CardLoading.__name__),
+                ('name', '=', 'post'),
+                ])
+        Button.write([button], {'groups': [('add', [group.id])]})
+        with self.assertRaises(AccessButtonError):
+            post_batch(company)
+
+        User.write([user], {'groups': [('add', [group.id])]})
+        contexts = []
+
+        def post_partition(database_name, user, context, ids):
+            contexts.append(context)
+
+        with patch.object(CardLoading, '_post_partition', post_partition):
+            self.assertEqual(post_batch(company), [])
+        context, = contexts
+        # The post button checks the access in the partition
+        self.assertTrue(context['_check_access'])
+
+    @with_transaction()
+    def test_card_loading_add_lines(self):
+        'Test fill preloaded card loading lines with the active parties'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        Party = pool.get('party.party')
+        CardLoading = pool.get('account.preloaded_card.loading')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            cash, = Account.search([
+                    ('company', '=', company.id),
+                    ('name', '=', 'Main Cash'),
+                    ])
+            journal, = Journal.search([('type', '=', 'cash')], limit=1)
+            party1, party2, party3 = Party.create([{
+                        'name': 'Party %s' % i,
+                        'identifiers': [('create', [{
+                                        'type': 'ar_tarjeta_precargada',
+                                        'code': code,
+                                        } for code in codes])],
+                        } for i, codes in enumerate(
+                        [['1111'], ['2222', '2223'], []], 1)])
+
+            card_loading = CardLoading(
+                credit_account=cash, debit_account=cash, journal=None,
+                lines=[])
+            with patch.object(CardLoading, '_get_active_parties',
+                    return_value=[party3.id, party1.id, party2.id]):
+                card_loading.add_lines()
+                self.assertFalse(card_loading.lines)
+
+                card_loading.journal = journal
+                card_loading.add_lines()
+
+            self.assertEqual(
+                [(l.party, l.card_number, l.amount)
+                    for l in card_loading.lines],
+                [(party3, None, Decimal(0)), (party1, '1111', Decimal(0)),
+                    (party2, None, Decimal(0))])
+
+    @with_transaction()
+    def test_card_loading_generate_from_previous(self):
+        'Test generate preloaded card loading lines from the previous one'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        Party = pool.get('party.party')
+        CardLoading = pool.get('account.preloaded_card.loading')
+        Line = pool.get('account.preloaded_card.loading.line')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            create_fiscalyear(company)
+            cash, = Account.search([
+                    ('company', '=', company.id),
+                    ('name', '=', 'Main Cash'),
+                    ])
+            receivable, = Account.search([
+                    ('company', '=', company.id),
+                    ('type.receivable', '=', True),
+                    ])
+            journal, = Journal.search([('type', '=', 'cash')], limit=1)
+            party1, party2, party3, party4 = Party.create([{
+                        'name': 'Party %s' % i,
+                        'identifiers': [('create', [{
+                                        'type': 'ar_tarjeta_precargada',
+                                        'code': code,
+                                        }])] if code else [],
+                        } for i, code in enumerate(
+                        ['1111', '2222', None, '4444'], 1)])
+
+            previous, = CardLoading.create([{
+                        'date': date(2021, 5, 10),
+                        'journal': journal.id,
+                        'credit_account': cash.id,
+                        'debit_account': receivable.id,
+                        'lines': [('create', [{
+                                        'party': party.id,
+                                        'card_number': card_number,
+                                        'amount': amount,
+                                        } for party, card_number, amount in [
+                                        (party1, '1111', Decimal('10.00')),
+                                        (party2, '9999', Decimal('20.00')),
+                                        (party3, '3333', Decimal('30.00')),
+                                        ]])],
+                        }])
+            card_loading, = CardLoading.create([{
+                        'date': date(2021, 6, 10),
+                        'journal': journal.id,
+                        'credit_account': cash.id,
+                        'debit_account': receivable.id,
+                        }])
+
+            with self.assertRaises(UserError):
+                CardLoading.generate_from_previous([card_loading])
+            CardLoading.post([previous])
+            with self.assertRaises(UserError):
+                CardLoading.generate_from_previous([previous])
+
+            # Without active parties, the parties of the lines are kept
+            CardLoading.generate_from_previous([card_loading])
+            self.assertEqual(
+                [(l.party, l.card_number, l.amount)
+                    for l in CardLoading(card_loading.id).lines],
+                [(party1, '1111', Decimal('10.00')),
+                    (party2, '2222', Decimal('20.00')),
+                    (party3, '3333', Decimal('30.00'))])
+
+            with patch.object(CardLoading, '_get_active_parties',
+                        return_value=[party4.id, party1.id, party2.id]), \
+                    patch.object(Line, 'write', wraps=Line.write) as write:
+                CardLoading.generate_from_previous([card_loading])
+
+            lines = CardLoading(card_loading.id).lines
+            self.assertEqual(
+                [(l.party, l.card_number, l.amount) for l in lines],
+                [(party1, '1111', Decimal('10.00')),
+                    (party2, '2222', Decimal('20.00')),
+                    (party4, '4444', Decimal('0.00'))])
+            # Only the changed card number is written
+            write.assert_called_once_with([lines[1]], {'card_number': '2222'})
+
+    @with_transaction()
+    def test_card_loading_report(self):
+        'Test the preloaded card loading bank file'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        Party = pool.get('party.party')
+        CardLoading = pool.get('account.preloaded_card.loading')
+        ActionReport = pool.get('ir.action.report')
+        Report = pool.get(
+            'account.preloaded_card.loading.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            cash, = Account.search([
+                    ('company', '=', company.id),
+                    ('name', '=', 'Main Cash'),
+                    ])
+            journal, = Journal.search([('type', '=', 'cash')], limit=1)
+            party, = Party.create([{'name': 'Party'}])
+            card_loadings = CardLoading.create([{
+                        'date': date(2021, 6, 10),
+                        'description': description,
+                        'journal': journal.id,
+                        'credit_account': cash.id,
+                        'debit_account': cash.id,
+                        'lines': [('create', [{
+                                        'party': party.id,
+                                        'card_number': '4000123456789010',
+                                        'amount': Decimal('1234.5'),
+                                        }, {
+                                        'party': party.id,
+                                        'amount': Decimal('-7.05'),
+                                        }])],
+                        } for description in ['Carga de Junio', 'Pensión']])
+
+            ids = [c.id for c in reversed(card_loadings)]
+            oext, content, _, _ = Report.execute(ids, {
+                    'model': CardLoading.__name__,
+                    'id': ids[0],
+                    'ids': ids,
+                    })
+
+            self.assertEqual(oext, 'txt')
+            self.assertEqual(content, (
+                    '4000123456789010000123450Pension%s\r\n'
+                    '000000705Pension%s\r\n'
+                    '4000123456789010000123450Carga de Junio%s\r\n'
+                    '000000705Carga de Junio%s\r\n') % (
+                    ' ' * 53, ' ' * 53, ' ' * 46, ' ' * 46))
+
+            # A customized template is rendered
+            action, = ActionReport.search([
+                    ('report_name', '=', Report.__name__),
+                    ])
+            with file_open(
+                    'account_statement_credicoop/preloaded_card_loading.txt',
+                    'rb') as f:
+                template = f.read()
+            action.report_content_custom = template
+            action.save()
+            with patch.object(Report, 'get_lines') as get_lines:
+                _, rendered, _, _ = Report.execute(ids, {
+                        'model': CardLoading.__name__,
+                        'id': ids[0],
+                        'ids': ids,
+                        })
+            get_lines.assert_not_called()
+            self.assertEqual(rendered, content)
+
+            action.report_content_custom = template.replace(b'\r\n', b'\n')
+            action.save()
+            _, rendered, _, _ = Report.execute(ids, {
+                    'model': CardLoading.__name__,
+                    'id': ids[0],
+                    'ids': ids,
+                    })
+            self.assertEqual(rendered, content.replace('\r\n', '\n'))
+
+    @with_transaction()
+    def test_precargada_identifier(self):
+        'Test Precargada card number and party resolution'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Identifier = pool.get('party.identifier')
+
+        party1, party2 = Party.create([{
+                    'name': 'Party 1',
+                    'identifiers': [('create', [{
+                                    'type': 'ar_tarjeta_precargada',
+                                    'code': '1111',
+                                    }])],
+                    }, {
+                    'name': 'Party 2',
+                    }])
+
+        self.assertEqual(Identifier.get_precargada_party('1111'), party1.id)
+        self.assertEqual(
+            Identifier.get_precargada_card_number(party1), '1111')
+        self.assertEqual(Identifier.get_precargada_party('2222'), None)
+        self.assertEqual(Identifier.get_precargada_card_number(party2), None)
+
+        identifier, = Identifier.create([{
+                    'party': party2.id,
+                    'type': 'ar_tarjeta_precargada',
+                    'code': '2222',
+                    }])
+        self.assertEqual(Identifier.get_precargada_party('2222'), party2.id)
+
+        Identifier.write([identifier], {'code': '1111'})
+        self.assertEqual(Identifier.get_precargada_party('1111'), None)
+        self.assertEqual(
+            Identifier.get_precargada_card_number(party2), '1111')
+
+        Identifier.delete([identifier])
+        self.assertEqual(Identifier.get_precargada_party('1111'), party1.id)
+        self.assertEqual(Identifier.get_precargada_card_number(party2), None)
+
+
+class PrecargadasTestCase(unittest.TestCase):
+    'Test Credicoop Precargadas parser'
+
+    def test_parse(self):
+        'Test parse'
+        precargadas = Precargadas(PRECARGADAS)
+        statement, = precargadas.statements
+
+        self.assertEqual(
+            statement.receiver, 'COOPERATIVA DE TRABAJO GCOOP LTDA')
+        self.assertEqual(statement.card_number, '4000-1234-5678-9010')
+        self.assertEqual(statement.date_from, date(2021, 11, 1))
+        self.assertEqual(statement.date_to, date(2021, 11, 30))
+        self.assertEqual(statement.debit_total, Decimal('7734.66'))
+        self.assertEqual(statement.credit_total, Decimal('15234.56'))
+        self.assertEqual(len(statement.moves), 5)
+
+        move = statement.moves[1]
+        self.assertEqual(move.date, date(2021, 11, 3))
+        self.assertEqual(move.op_number, '100245')
+        self.assertEqual(move.name, 'COMPRA')
+        self.assertEqual(move.description1, 'Librería Ñandú')
+        self.assertEqual(move.description2, 'Compra en comercio')
+        self.assertEqual(move.debit, Decimal('1234.56'))
+        self.assertEqual(move.credit, Decimal('0.00'))
+
+    def test_parse_streaming(self):
+        'Test parse streaming from bytes'
+        with open(PRECARGADAS, 'rb') as f:
+            data = f.read()
+        expected, = Precargadas(PRECARGADAS).statements
+
+        precargadas = Precargadas(io.BytesIO(data), streaming=True)
+        statement, = precargadas.statements
+
+        self.assertEqual(statement.card_number, expected.card_number)
+        self.assertEqual(statement.date_from, expected.date_from)
+        self.assertEqual(statement.date_to, expected.date_to)
+        self.assertNotIsInstance(statement.moves, list)
+        moves = list(statement.moves)
+        self.assertEqual(
+            [(m.date, m.op_number, m.debit, m.credit) for m in moves],
+            [(m.date, m.op_number, m.debit, m.credit)
+                for m in expected.moves])
+        self.assertEqual(statement.debit_total, expected.debit_total)
+        self.assertEqual(statement.credit_total, expected.credit_total)
+
+    def test_parse_multiple(self):
+        'Test parse many statements in a file'
+        with open(PRECARGADAS, 'rb') as f:
+            data = f.read()
+        data += data.replace(b'9010', b'9011').replace(b',100', b',200')
+
+        for streaming in [False, True]:
+            statements = Precargadas(
+                io.BytesIO(data), streaming=streaming).statements
+            self.assertEqual([
+                    (s.card_number, [m.op_number for m in s.moves],
+                        s.debit_total)
+                    for s in statements], [
+                    ('4000-1234-5678-9010',
+                        ['100231', '100245', '100302', '100355', '100410'],
+                        Decimal('7734.66')),
+                    ('4000-1234-5678-9011',
+                        ['200231', '200245', '200302', '200355', '200410'],
+                        Decimal('7734.66')),
+                    ])
+
+        # The moves are kept when reading the next statement first
+        first, second = Precargadas(
+            io.BytesIO(data), streaming=True).statements
+        self.assertEqual(len(list(first.moves)), 5)
+        self.assertEqual(len(list(second.moves)), 5)
+
+    def test_skip_moves(self):
+        'Test skip moves by fingerprint'
+        with open(PRECARGADAS, 'rb') as f:
+            data = f.read()
+        expected, = Precargadas(io.BytesIO(data)).statements
+        fingerprint = expected.moves[2].fingerprint
+
+        for streaming in [False, True]:
+            for skip, numbers in [
+                    (fingerprint, ['100355', '100410']),
+                    ('wrong', [m.op_number for m in expected.moves]),
+                    ]:
+                statement, = Precargadas(
+                    io.BytesIO(data), streaming=streaming).statements
+                statement.skip_moves(3, skip)
+                self.assertEqual(
+                    [m.op_number for m in statement.moves], numbers)
+                self.assertEqual(
+                    statement.skipped, 3 if skip == fingerprint else 0)
+                self.assertEqual(
+                    statement.fingerprint, expected.fingerprint)
+
+    def test_parse_moves(self):
+        'Test parse moves by column as by row'
+        with open(PRECARGADAS, encoding='windows-1252', newline='') as f:
+            rows = [r for r in list(csv.reader(f))[8:] if r[1] != '']
+        rows.append(
+            ['', '1/2/2021', ' 1 ', 'A', '', '', '', '', '1,5', '', '', '',
+                '.1.000,001'])
+        rows.append(
+            ['', ' 29/02/2020 ', '', '', ' B ', '', ' C ', '', '-0,00',
+                '', '', '', '12'])
+
+        precargadas = Precargadas(PRECARGADAS)
+        statement = Statement()
+        statement.debit_total = statement.credit_total = 0
+        moves = precargadas._parse_moves(rows, statement)
+
+        debit_total = credit_total = 0
+        self.assertEqual(len(moves), len(rows))
+        for row, move in zip(rows, moves):
+            expected = Move()
+            precargadas._parse_move(row, expected, MOVE)
+            for name in MOVE:
+                self.assertEqual(
+                    repr(getattr(move, name)), repr(getattr(expected, name)))
+            debit_total += expected.debit
+            credit_total += expected.credit
+        self.assertEqual(repr(statement.debit_total), repr(debit_total))
+        self.assertEqual(repr(statement.credit_total), repr(credit_total))
+
+    def test_move_store(self):
+        'Test moves stored by column'
+        precargadas = Precargadas(PRECARGADAS)
+        statement, = precargadas.statements
+        moves = statement.moves
+
+        self.assertIsInstance(moves, MoveStore)
+        self.assertEqual(moves._columns['date'][0].typecode, 'i')
+        self.assertEqual(moves._columns['debit'][0].typecode, 'q')
+        self.assertEqual(
+            [m.op_number for m in moves[3:]], ['100355', '100410'])
+        self.assertEqual(moves[-1].fingerprint, statement.fingerprint)
+        self.assertEqual(moves[2:][0].fingerprint, moves[2].fingerprint)
+        self.assertEqual(repr(moves[1].credit), repr(Decimal('0.00')))
+        with self.assertRaises(IndexError):
+            moves[5]
+        with self.assertRaises(AttributeError):
+            moves[0].amount
+
+    def test_parse_files(self):
+        'Test parse files in parallel'
+        with open(PRECARGADAS, 'rb') as f:
+            data = f.read()
+        files = [data, data.replace(b'9010', b'9011')] * 3
+
+        with patch('trytond.modules.account_statement_credicoop.'
+                'credicoop_precargadas.subprocess.run',
+                wraps=subprocess.run) as run:
+            statements = parse_files(files, max_workers=2, min_size=0)
+
+        # One child per worker
+        self.assertEqual(run.call_count, 2)
+        self.assertEqual([s.card_number for s in statements],
+            ['4000-1234-5678-9010', '4000-1234-5678-9011'] * 3)
+        for statement in statements:
+            self.assertEqual(
+                [m.op_number for m in statement.moves],
+                ['100231', '100245', '100302', '100355', '100410'])
+            self.assertEqual(statement.debit_total, Decimal('7734.66'))
+        with patch('trytond.modules.account_statement_credicoop.'
+                'credicoop_precargadas.subprocess.run') as run:
+            self.assertEqual(
+                [s.card_number for s in parse_files(files, max_workers=1)],
+                [s.card_number for s in statements])
+            self.assertEqual(
+                [s.card_number for s in parse_files(files, max_workers=2)],
+                [s.card_number for s in statements])
+        # Parsed in process with one worker or a small archive
+        run.assert_not_called()
+
+    def test_parse_files_unguarded_script(self):
+        'Test parse files in parallel from a script without main guard'
+        with tempfile.TemporaryDirectory() as directory:
+            script = os.path.join(directory, 'script.py')
+            with open(script, 'w') as f:
+                f.write(
+                    'import sys\n'
+                    'from trytond.modules.account_statement_credicoop'
+                    '.credicoop_precargadas import parse_files\n'
+                    'print("SCRIPT EXECUTED", __name__)\n'
+                    'with open(sys.argv[1], "rb") as f:\n'
+                    '    data = f.read()\n'
+                    'statements = parse_files(\n'
+                    '    [data, data], max_workers=2, min_size=0)\n'
+                    'print([len(s.moves) for s in statements])\n')
+            process = subprocess.run(
+                [sys.executable, script, PRECARGADAS],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=directory, check=True, universal_newlines=True)
+
+        self.assertEqual(process.stdout.splitlines(), [
+                'SCRIPT EXECUTED __main__',
+                '[5, 5]',
+                ])
+        self.assertNotIn('parse process failed', process.stderr)
+
+
+class FormatTestCase(unittest.TestCase):
+    'Test Credicoop fixed-width formatting'
+
+    def test_strip_accents(self):
+        'Test strip accents'
+        for string, result in [
+                ('Carga', 'Carga'),
+                ('Pensión Año', 'Pension Ano'),
+                ('Pensio\u0301n', 'Pension'),
+                ('ÀÉÎÕÜ çñ', 'AEIOU cn'),
+                ('€ 1º', '€ 1º'),
+                ]:
+            self.assertEqual(strip_accents(string), result)
+
+    def test_format_description(self):
+        'Test format description'
+        self.assertEqual(format_description('Pensión'), 'Pension' + ' ' * 53)
+        self.assertEqual(format_description(None, 3), '   ')
+        self.assertEqual(format_description('x' * 70), 'x' * 70)
+
+    def test_format_amount(self):
+        'Test format amount'
+        for amount, result in [
+                (Decimal('1234.5'), '000123450'),
+                (Decimal('-7.05'), '000000705'),
+                (Decimal('-0.00'), '000000000'),
+                (Decimal('0.125'), '000000012'),
+                (Decimal('1E+3'), '000100000'),
+                (Decimal('12345678901.23'), '1234567890123'),
+                (15, '000001500'),
+                ]:
+            self.assertEqual(format_amount(amount), result)
+
 
 def suite():
     suite = test_suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
             AccountStatementTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            PrecargadasTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            FormatTestCase))
     return suite